@@ -0,0 +1,64 @@
+#-*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from folivora.models import Package
+from folivora.tasks import backfill_versions
+from folivora.utils.clients import (get_batch_size, get_breaker,
+    get_pypi_servers, report_server_stats)
+from folivora.utils.pypi import (ConcurrentCheeseShop, DEFAULT_CONCURRENCY,
+    get_server_stats)
+
+
+class Command(BaseCommand):
+    help = ('Fetch the versions of all packages that were never synced, '
+            'with many requests in flight at once.')
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', type='int', default=DEFAULT_CONCURRENCY,
+                    help='Number of concurrent requests.'),
+        make_option('--batch-size', type='int', default=None,
+                    help='Number of calls sent in one multicall, defaults '
+                         'to FOLIVORA_PYPI_BATCH_SIZE.'),
+        make_option('--chunk-size', type='int', default=500,
+                    help='Number of packages fetched before they are stored.'),
+        make_option('--tracked', action='store_true', default=False,
+                    help='Only packages at least one project depends on.'),
+        make_option('--server', default=None,
+                    help='URL of the XML-RPC endpoint, defaults to '
+                         'FOLIVORA_PYPI_SERVERS.'),
+    )
+
+    def handle(self, **options):
+        # Packages of the mirror provider are read from disk on demand.
+        packages = Package.objects.filter(initial_sync_done=False,
+                                          provider=Package.PYPI)
+        if options['tracked']:
+            packages = packages.filter(projectdependency__isnull=False)
+        ids = sorted(set(packages.values_list('id', flat=True)))
+        chunk_size = options['chunk_size']
+        batch_size = options['batch_size'] or get_batch_size()
+
+        servers = [options['server']] if options['server'] \
+            else get_pypi_servers()
+        client = ConcurrentCheeseShop(servers,
+                                      options['concurrency'],
+                                      batch_size=batch_size,
+                                      get_guard=get_breaker,
+                                      report=report_server_stats)
+        synced = 0
+        try:
+            for offset in xrange(0, len(ids), chunk_size):
+                chunk = Package.objects.filter(
+                    pk__in=ids[offset:offset + chunk_size])
+                synced += backfill_versions(client, chunk)
+                if int(options['verbosity']) > 1:
+                    self.stdout.write('%d/%d packages\n' % (
+                                      min(offset + chunk_size, len(ids)),
+                                      len(ids)))
+        finally:
+            client.close()
+            # Requests since the last periodic report.
+            for url in servers:
+                report_server_stats(get_server_stats(url), interval=0)
+        self.stdout.write('Synced the versions of %d packages.\n' % synced)
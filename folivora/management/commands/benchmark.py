@@ -0,0 +1,85 @@
+#-*- coding: utf-8 -*-
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from folivora.models import Project, Log, SyncState
+from folivora.tasks import sync_with_changelog, sync_project
+from folivora.utils.benchmark import (benchmark_database, populate, measure,
+    local_tasks, SyntheticCheeseShop)
+from folivora.utils.clients import use_client
+from folivora.utils.notifications import send_notifications
+
+
+class Command(BaseCommand):
+    args = '[<output.json>]'
+    help = ('Time tasks and views against a temporary database of synthetic '
+            'packages and projects, results are written as JSON.')
+    option_list = BaseCommand.option_list + (
+        make_option('--packages', type='int', default=1000,
+                    help='Number of packages.'),
+        make_option('--versions', type='int', default=10,
+                    help='Number of versions per package.'),
+        make_option('--projects', type='int', default=100,
+                    help='Number of projects.'),
+        make_option('--dependencies', type='int', default=20,
+                    help='Number of dependencies per project.'),
+        make_option('--releases', type='int', default=100,
+                    help='Number of new releases in the changelog.'),
+    )
+
+    def handle(self, output=None, **options):
+        params = dict((key, options[key]) for key in ('packages', 'versions',
+                      'projects', 'dependencies', 'releases'))
+        verbosity = int(options['verbosity'])
+        with benchmark_database(verbosity):
+            with local_tasks():
+                results = self.run_benchmarks(params)
+        data = json.dumps({'parameters': params, 'results': results},
+                          indent=2, sort_keys=True)
+        if output is None:
+            self.stdout.write(data + '\n')
+        else:
+            with open(output, 'w') as f:
+                f.write(data)
+
+    def run_benchmarks(self, params):
+        populate(params['packages'], params['versions'], params['projects'],
+                 params['dependencies'])
+        results = {}
+        project = Project.objects.order_by('pk')[0]
+
+        r, results['sync_project'] = measure(sync_project.apply,
+                                             args=(project.pk,))
+        r.get()
+
+        log_entries = list(Log.objects.filter(project=project))
+        r, results['send_notifications'] = measure(send_notifications,
+                                                   project, log_entries)
+
+        SyncState.objects.create(type=SyncState.CHANGELOG, last_serial=0)
+        client = SyntheticCheeseShop(params['releases'])
+        with use_client(client):
+            r, results['sync_with_changelog'] = measure(
+                sync_with_changelog.apply)
+        r.get()
+
+        browser = Client()
+        user = project.members.all()[0]
+        user.set_password('benchmark')
+        user.save()
+        browser.login(username=user.username, password='benchmark')
+        for name, url in (
+                ('DashboardView', reverse('folivora_dashboard')),
+                ('DetailProjectView', project.get_absolute_url()),
+                ('UpdateProjectDependencyView',
+                 reverse('folivora_project_dependency_update',
+                         kwargs={'slug': project.slug}))):
+            response, results[name] = measure(browser.get, url)
+            if response.status_code != 200:
+                raise CommandError('%s returned %d' % (
+                                   url, response.status_code))
+        return results
@@ -0,0 +1,24 @@
+#-*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from folivora.utils.snapshot import export_catalog
+
+
+class Command(BaseCommand):
+    args = '<snapshot>'
+    help = ('Write all packages and versions to a compressed snapshot, '
+            'see import_snapshot.')
+    option_list = BaseCommand.option_list + (
+        make_option('--compresslevel', type='int', default=6,
+                    help='gzip compression level, from 1 to 9.'),
+    )
+
+    def handle(self, snapshot=None, **options):
+        if snapshot is None:
+            raise CommandError('Usage: manage.py export_snapshot <snapshot>')
+        with open(snapshot, 'wb') as f:
+            packages, versions = export_catalog(f, options['compresslevel'])
+        self.stdout.write('Exported %d packages and %d versions.\n'
+                          % (packages, versions))
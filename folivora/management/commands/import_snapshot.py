@@ -0,0 +1,27 @@
+#-*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from folivora.utils.snapshot import import_catalog
+
+
+class Command(BaseCommand):
+    args = '<snapshot>'
+    help = ('Load packages and versions from a snapshot written by '
+            'export_snapshot.  Known packages and versions are kept.')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=10000,
+                    help='Number of rows sent with one COPY.'),
+    )
+
+    def handle(self, snapshot=None, **options):
+        if snapshot is None:
+            raise CommandError('Usage: manage.py import_snapshot <snapshot>')
+        try:
+            with open(snapshot, 'rb') as f:
+                packages, versions = import_catalog(f, options['chunk_size'])
+        except (IOError, ValueError) as exc:
+            raise CommandError('Could not import %s: %s' % (snapshot, exc))
+        self.stdout.write('Imported %d new packages and %d new versions.\n'
+                          % (packages, versions))
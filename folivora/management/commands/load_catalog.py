@@ -0,0 +1,84 @@
+#-*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from folivora.models import Package, SyncState
+from folivora.utils.bulk import copy_rows, normalized_name_sql
+from folivora.utils.clients import get_pypi_client
+from folivora.utils.pypi import DEFAULT_SERVER
+
+
+STAGING_TABLE = 'folivora_package_staging'
+
+
+def load_package_names(names, chunk_size=10000):
+    """Insert all `names` that are not known yet, returns their number.
+
+    Names are sent in chunks with COPY to a temporary staging table and
+    merged into the package table with one statement.  The normalized
+    name is computed by the database, like :func:`normalize_name` does.
+    """
+    cursor = connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE %s (name varchar(255)) '
+                   'ON COMMIT DROP' % STAGING_TABLE)
+    copy_rows(cursor, STAGING_TABLE, ('name',),
+              ((name,) for name in names), chunk_size)
+    # Names are unique, but normalized names may clash and only one of
+    # the names can be stored.
+    cursor.execute(
+        "INSERT INTO folivora_package (name, normalized_name, url, provider, "
+        "initial_sync_done) "
+        "SELECT DISTINCT ON (normalized_name) name, normalized_name, "
+        "left(%%s || name, 200), %%s, false FROM ("
+        "  SELECT name, %s AS normalized_name FROM %s) AS staged "
+        "ORDER BY normalized_name, name "
+        "ON CONFLICT DO NOTHING" % (normalized_name_sql('name'),
+                                    STAGING_TABLE),
+        [DEFAULT_SERVER, Package.PYPI])
+    return cursor.rowcount
+
+
+class Command(BaseCommand):
+    help = ('Load the names of all packages on PyPi.  Only unknown names '
+            'are inserted, so the command can be run again at any time.')
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', default=False,
+                    help='Delete all packages (and their dependencies!) '
+                         'and restart the changelog sync.'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True, help='Do not ask for confirmation.'),
+        make_option('--chunk-size', type='int', default=10000,
+                    help='Number of names sent with one COPY.'),
+        make_option('--server', default=None,
+                    help='URL of the XML-RPC endpoint, defaults to '
+                         'FOLIVORA_PYPI_SERVERS.'),
+    )
+
+    def handle(self, **options):
+        if options['reset'] and options['interactive']:
+            answer = raw_input('This deletes all packages and dependencies, '
+                               'are you sure? [y/n]: ')
+            if answer != 'y':
+                raise CommandError('Aborted.')
+
+        client = get_pypi_client(options['server'])
+        # Query the serial first, the changelog rather repeats events
+        # than missing some.
+        serial = client.get_last_serial()
+        names = client.get_package_list()
+
+        with transaction.commit_on_success():
+            if options['reset']:
+                Package.objects.all().delete()
+                SyncState.objects.all().delete()
+            if not SyncState.objects.filter(
+                    type=SyncState.CHANGELOG).exists():
+                SyncState.objects.create(type=SyncState.CHANGELOG,
+                                         last_sync=timezone.now(),
+                                         last_serial=serial)
+            created = load_package_names(names, options['chunk_size'])
+        self.stdout.write('Loaded %d new of %d packages.\n'
+                          % (created, len(names)))
@@ -0,0 +1,45 @@
+#-*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from folivora.models import SyncState
+from folivora.utils.changelog import compact_changelog
+from folivora.utils.clients import (get_batch_size, get_breaker,
+    get_pypi_servers)
+from folivora.utils.recording import RecordingCheeseShop
+
+
+class Command(BaseCommand):
+    args = '<fixture>'
+    help = ('Record the PyPi changelog since a serial together with the '
+            'releases needed to apply it, see replay_changelog.')
+    option_list = BaseCommand.option_list + (
+        make_option('--serial', type='int', default=None,
+                    help='Serial to record from, defaults to the serial '
+                         'of the last changelog sync.'),
+    )
+
+    def handle(self, fixture=None, **options):
+        if fixture is None:
+            raise CommandError('Usage: manage.py record_changelog <fixture>')
+        serial = options['serial']
+        if serial is None:
+            serials = SyncState.objects.filter(type=SyncState.CHANGELOG) \
+                                       .values_list('last_serial', flat=True)
+            if not serials or serials[0] is None:
+                raise CommandError('No serial synced yet, use --serial.')
+            serial = serials[0]
+
+        client = RecordingCheeseShop(get_pypi_servers(),
+                                     batch_size=get_batch_size(),
+                                     get_guard=get_breaker)
+        log = client.get_changelog_since_serial(serial)
+        names = [name for name, changes in compact_changelog(log).iteritems()
+                 if changes.released]
+        versions = client.get_multiple_package_versions(names)
+        for name in names:
+            client.get_multiple_release_urls(name, versions[name])
+        client.save(fixture)
+        self.stdout.write('Recorded %d events since serial %d, %d released '
+                          'packages.\n' % (len(log), serial, len(names)))
@@ -0,0 +1,64 @@
+#-*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from folivora.models import SyncState
+from folivora.tasks import sync_with_changelog
+from folivora.utils.benchmark import (benchmark_database, populate, measure,
+    local_tasks)
+from folivora.utils.changelog import compact_changelog
+from folivora.utils.clients import use_client
+from folivora.utils.recording import ReplayCheeseShop
+
+
+class Command(BaseCommand):
+    args = '<fixture>'
+    help = ('Replay a changelog recorded with record_changelog against a '
+            'temporary database of synthetic projects and report '
+            'throughput, queries and memory.')
+    option_list = BaseCommand.option_list + (
+        make_option('--packages', type='int', default=1000,
+                    help='Number of packages.'),
+        make_option('--versions', type='int', default=10,
+                    help='Number of versions per synthetic package.'),
+        make_option('--projects', type='int', default=100,
+                    help='Number of projects.'),
+        make_option('--dependencies', type='int', default=20,
+                    help='Number of dependencies per project.'),
+    )
+
+    def handle(self, fixture=None, **options):
+        if fixture is None:
+            raise CommandError('Usage: manage.py replay_changelog <fixture>')
+        client = ReplayCheeseShop(fixture)
+        method, args, log = client.get_recorded_changelog()
+        if method != 'changelog_since_serial':
+            raise CommandError('Only changelogs recorded by serial can be '
+                               'replayed.')
+        names = [name for name, changes in compact_changelog(log).iteritems()
+                 if changes.released]
+
+        verbosity = int(options['verbosity'])
+        with benchmark_database(verbosity):
+            populate(options['packages'], options['versions'],
+                     options['projects'], options['dependencies'], names)
+            SyncState.objects.create(type=SyncState.CHANGELOG,
+                                     last_serial=args[0])
+            # Everything runs in this process, against the fixture and
+            # without sending mails.
+            with use_client(client):
+                with local_tasks():
+                    result, stats = measure(sync_with_changelog.apply)
+        result.get()
+
+        events = max(len(log), 1)
+        self.stdout.write('Events:                     %d\n' % len(log))
+        self.stdout.write('Events/sec:                 %.1f\n'
+                          % (len(log) / max(stats['time'], 1e-6)))
+        self.stdout.write('Queries/event:              %.2f\n'
+                          % (float(stats['queries']) / events))
+        self.stdout.write('Rows/event:                 %.2f\n'
+                          % (float(stats['rows']) / events))
+        self.stdout.write('Peak memory increase (KiB): %d\n'
+                          % stats['peak_memory_increase'])
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 import time
+import zlib
 import urlparse
 import datetime
 
 import pytz
 
 from django.conf import settings
-from django.db import models
+from django.db import models, connection, transaction
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import make_aware, now
@@ -15,16 +16,23 @@ from django.contrib.auth.models import User
 
 from django_orm.postgresql import hstore
 
-from .utils.pypi import DEFAULT_SERVER, CheeseShop, normalize_name
+from .utils.locks import advisory_lock, PACKAGE_SYNC
+from .utils.pypi import DEFAULT_SERVER, normalize_name
+from .utils.cache import cached_client
+from .utils.clients import get_pypi_client
+from .utils.mirror import get_mirror
+from .utils.versions import version_sort_key, versions_since
 
 
-PROVIDES = ('pypi',)
+PROVIDES = ('pypi', 'mirror')
 
 
 class Package(models.Model):
     PYPI = 'pypi'
+    MIRROR = 'mirror'
     PROVIDER_CHOICES = (
         (PYPI, 'PyPi'),
+        (MIRROR, _('Local mirror')),
     )
 
     name = models.CharField(_('name'), max_length=255, unique=True)
@@ -34,34 +42,155 @@ class Package(models.Model):
     provider = models.CharField(_('provider'), max_length=255,
         choices=PROVIDER_CHOICES, default=PYPI)
     initial_sync_done = models.BooleanField(default=False)
+    # Lowest version of a partial history, see `sync_versions`.
+    synced_from = models.CharField(_('synced from'), max_length=255,
+                                   null=True, blank=True)
+    latest_version = models.ForeignKey('PackageVersion',
+        verbose_name=_('latest version'), related_name='+', null=True,
+        blank=True, default=None, on_delete=models.SET_NULL)
 
     @classmethod
-    def create_with_provider_url(cls, name, provider='pypi', url=None):
+    def from_name(cls, name, provider='pypi', url=None):
+        """Build an unsaved package, ready for `bulk_create`."""
         if url is None:
             url = urlparse.urljoin(DEFAULT_SERVER, name)
-        pkg = cls(name=name, url=url, provider=provider)
+        return cls(name=name, url=url, provider=provider,
+                   normalized_name=normalize_name(name))
+
+    @classmethod
+    def create_with_provider_url(cls, name, provider='pypi', url=None):
+        pkg = cls.from_name(name, provider, url)
         pkg.save()
         return pkg
 
-    def sync_versions(self):
-        if self.initial_sync_done:
+    def get_client(self):
+        """Return the client to fetch the versions of this package from.
+
+        Packages of the mirror provider are read from the mirror in
+        ``FOLIVORA_MIRROR_ROOT``, everything else comes from PyPi.
+        """
+        if self.provider == self.MIRROR:
+            return get_mirror(settings.FOLIVORA_MIRROR_ROOT)
+        return cached_client(get_pypi_client())
+
+    @classmethod
+    def get_lowest_pins(cls, package_ids):
+        """Return the lowest pinned version of the given packages, mapped
+        by package id, with one query.
+        """
+        versions = {}
+        for package, version in ProjectDependency.objects \
+                .filter(package__in=list(package_ids)) \
+                .values_list('package', 'version').distinct():
+            versions.setdefault(package, []).append(version)
+        return dict((package, min(pins, key=version_sort_key))
+                    for package, pins in versions.iteritems())
+
+    def get_lowest_pin(self):
+        """Return the lowest version any project pins or `None`."""
+        return self.get_lowest_pins([self.pk]).get(self.pk)
+
+    def get_sync_since(self):
+        """Return the lowest version :meth:`sync_versions` has to store.
+
+        With ``FOLIVORA_PARTIAL_SYNC`` enabled that is the lowest pinned
+        version, otherwise (or without pins) `None` for all versions.
+        """
+        if not getattr(settings, 'FOLIVORA_PARTIAL_SYNC', False):
+            return None
+        return self.get_lowest_pin()
+
+    def needs_sync(self, since):
+        """Whether :meth:`sync_versions` has to fetch versions from `since`
+        on, `None` meaning the full history.
+        """
+        if not self.initial_sync_done:
+            return True
+        if self.synced_from is None:
+            return False
+        return (since is None or
+                version_sort_key(since) < version_sort_key(self.synced_from))
+
+    def sync_versions(self, client=None, versions=None, release_urls=None):
+        """Fetch the versions of this package with their release dates.
+
+        Only versions from :meth:`get_sync_since` on are fetched, which is
+        recorded in :attr:`synced_from`.  A partial history is widened once
+        an older version is pinned.
+
+        :param client: The :class:`CheeseShop` to use, by default the one
+                       returned by :meth:`get_client`.
+        :param versions: Already fetched versions of this package.
+        :param release_urls: Already fetched release urls, mapped by
+                             version.  Missing versions are fetched.
+        """
+        if self.initial_sync_done and self.synced_from is None:
             return
-        client = CheeseShop()
-        versions = client.get_package_versions(self.name)
-        for version in versions:
-            urls = client.get_release_urls(self.name, version)
+        since = self.get_sync_since()
+        if not self.needs_sync(since):
+            return
+        # Only one worker fetches a package, the others wait and find the
+        # versions already synced afterwards.
+        with advisory_lock(PACKAGE_SYNC, self.pk):
+            self.initial_sync_done, self.synced_from = \
+                Package.objects.filter(pk=self.pk).values_list(
+                    'initial_sync_done', 'synced_from')[0]
+            if self.needs_sync(since):
+                self._fetch_versions(client, versions, release_urls, since)
+        self.latest_version = self.get_latest_version()
+
+    def _fetch_versions(self, client, versions, release_urls, since):
+        if client is None:
+            client = self.get_client()
+        if versions is None:
+            versions = client.get_package_versions(self.name)
+        wanted = versions_since(versions, since)
+        if self.initial_sync_done:
+            # Widening a partial history, newer versions are stored already.
+            stored = version_sort_key(self.synced_from)
+            wanted = [v for v in wanted if version_sort_key(v) < stored]
+        release_urls = dict(release_urls or {})
+        missing = [v for v in wanted if v not in release_urls]
+        if missing:
+            release_urls.update(client.get_multiple_release_urls(self.name,
+                                                                 missing))
+        new_versions = []
+        for version in wanted:
+            urls = release_urls[version]
             if urls:
                 url = urls[0]
                 utime = time.mktime(url['upload_time'].timetuple())
                 release_date = make_aware(
                     datetime.datetime.fromtimestamp(utime),
                     pytz.UTC)
-                PackageVersion.objects.get_or_create(
-                    package=self,
-                    version=version,
-                    release_date=release_date)
+                new_versions.append(PackageVersion(package=self,
+                                                   version=version,
+                                                   release_date=release_date))
+        with transaction.commit_on_success():
+            PackageVersion.bulk_insert(new_versions)
+            Package.objects.filter(pk=self.pk).update(initial_sync_done=True,
+                                                      synced_from=since)
         self.initial_sync_done = True
-        self.save()
+        self.synced_from = since
+
+    @classmethod
+    def update_latest_versions(cls, package_ids):
+        """Recompute :attr:`latest_version` of the given packages."""
+        package_ids = list(package_ids)
+        if not package_ids:
+            return
+        cursor = connection.cursor()
+        cursor.execute('UPDATE folivora_package SET latest_version_id = ('
+                       'SELECT id FROM folivora_packageversion '
+                       'WHERE package_id = folivora_package.id '
+                       'ORDER BY sort_key DESC LIMIT 1) '
+                       'WHERE id IN %s', [tuple(package_ids)])
+        transaction.commit_unless_managed()
+
+    def get_latest_version(self):
+        """Return the most recent :class:`PackageVersion` or `None`."""
+        versions = self.versions.order_by('-sort_key')[:1]
+        return versions[0] if versions else None
 
     def save(self, *args, **kwargs):
         if not self.normalized_name:
@@ -85,6 +214,39 @@ class PackageVersion(models.Model):
                                 related_name='versions')
     version = models.CharField(_('version'), max_length=255)
     release_date = models.DateTimeField(_('release date'))
+    # Compared with "C" collation and indexed together with `package`,
+    # see migration 0010.
+    sort_key = models.TextField(_('sort key'), editable=False)
+
+    @classmethod
+    def bulk_insert(cls, versions):
+        """Insert `versions` with one statement.
+
+        Versions that already exist for their package are skipped, which
+        makes this safe to use while other workers insert the same rows.
+        :attr:`Package.latest_version` is updated for all packages.
+
+        :param versions: List of unsaved :class:`PackageVersion` objects.
+        """
+        if not versions:
+            return
+        params = []
+        for version in versions:
+            params.extend((version.package_id, version.version,
+                           version.release_date,
+                           version_sort_key(version.version)))
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(versions))
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO %s (package_id, version, release_date, '
+                       'sort_key) VALUES %s ON CONFLICT (package_id, version) '
+                       'DO NOTHING' % (cls._meta.db_table, values), params)
+        transaction.commit_unless_managed()
+        Package.update_latest_versions(set(v.package_id for v in versions))
+
+    def save(self, *args, **kwargs):
+        self.sort_key = version_sort_key(self.version)
+        super(PackageVersion, self).save(*args, **kwargs)
+        Package.update_latest_versions([self.package_id])
 
     class Meta:
         verbose_name = _('package version')
@@ -198,6 +360,23 @@ class ProjectDependency(models.Model):
     def update_available(self):
         return self.update_id is not None
 
+    @classmethod
+    def update_to_latest_versions(cls, dependency_ids):
+        """Point `update` of the given dependencies to the latest version
+        of their package.
+        """
+        dependency_ids = list(dependency_ids)
+        if not dependency_ids:
+            return
+        cursor = connection.cursor()
+        cursor.execute('UPDATE folivora_projectdependency '
+                       'SET update_id = folivora_package.latest_version_id '
+                       'FROM folivora_package WHERE folivora_package.id = '
+                       'folivora_projectdependency.package_id AND '
+                       'folivora_projectdependency.id IN %s',
+                       [tuple(dependency_ids)])
+        transaction.commit_unless_managed()
+
     @classmethod
     def process_formset(cls, formset, original_data, user):
         remove = []
@@ -259,6 +438,72 @@ class SyncState(models.Model):
     state = models.CharField(max_length=255, choices=STATE_CHOICES,
                              default=STATE_RUNNING)
     last_sync = models.DateTimeField(_('Last Sync'), default=now)
+    last_serial = models.IntegerField(_('Last Serial'), null=True)
+
+
+class ServiceState(models.Model):
+    """Circuit breaker and rate limiter state of a remote service.
+
+    Shared by all workers, see :class:`folivora.utils.circuit.CircuitBreaker`.
+    Every PyPi server has its own row.
+    Times are seconds since the epoch.
+
+    `requests`, `errors`, `latency` (seconds) and `error_rate` are reported
+    by the workers for monitoring, see
+    :func:`folivora.utils.clients.report_server_stats`.
+    """
+    name = models.CharField(_('name'), max_length=255, unique=True)
+    failures = models.IntegerField(_('failures'), default=0)
+    opened_until = models.FloatField(_('opened until'), default=0)
+    tokens = models.FloatField(_('tokens'))
+    rate = models.FloatField(_('rate'))
+    updated = models.FloatField(_('updated'))
+    requests = models.IntegerField(_('requests'), default=0)
+    errors = models.IntegerField(_('errors'), default=0)
+    latency = models.FloatField(_('latency'), null=True, blank=True)
+    error_rate = models.FloatField(_('error rate'), default=0)
+
+    class Meta:
+        verbose_name = _('service state')
+        verbose_name_plural = _('service states')
+
+    def __unicode__(self):
+        return self.name
+
+
+class ChangelogEvent(models.Model):
+    """Journal of raw PyPi changelog events.
+
+    Events are written by :func:`folivora.tasks.sync_with_changelog` and
+    applied per `shard` by :func:`folivora.tasks.apply_journal`.  All
+    events of a package share a shard so they are applied in order.
+    """
+    name = models.CharField(_('name'), max_length=255)
+    version = models.CharField(_('version'), max_length=255, null=True,
+                               blank=True)
+    timestamp = models.IntegerField(_('timestamp'))
+    action = models.TextField(_('action'))
+    serial = models.IntegerField(_('serial'), null=True, unique=True)
+    shard = models.PositiveSmallIntegerField(_('shard'))
+    applied = models.BooleanField(_('applied'), default=False)
+
+    class Meta:
+        verbose_name = _('changelog event')
+        verbose_name_plural = _('changelog events')
+
+    def __unicode__(self):
+        return u'{} {}'.format(self.name, self.action)
+
+    @staticmethod
+    def get_shard(name, shards):
+        """Return the shard of all events of the package `name`."""
+        return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % shards
+
+    @property
+    def event(self):
+        """The event as returned by :class:`CheeseShop`."""
+        return (self.name, self.version, self.timestamp, self.action,
+                self.serial)
 
 
 class UserProfile(models.Model):
@@ -10,39 +10,171 @@ import time
 import datetime
 import socket
 import logging
+import xmlrpclib
 import pytz
-from celery import task
+from celery import task, group
 from celery.task import current
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
 from django.utils import timezone
-from distutils.version import LooseVersion
 
 from .models import (SyncState, Package, PackageVersion,
-    ProjectDependency, Log, Project)
-from .utils.pypi import CheeseShop
+    ProjectDependency, Log, Project, ChangelogEvent)
+from .utils.cache import invalidate_packages
+from .utils.clients import get_pypi_client
+from .utils.circuit import Unavailable
+from .utils.changelog import compact_changelog
+from .utils.locks import (advisory_lock, try_advisory_lock,
+    CHANGELOG_FETCH, JOURNAL_SHARD)
+from .utils.versions import version_sort_key, versions_since
 from .utils.notifications import send_notifications
 
 
 logger = logging.getLogger(__name__)
 
 
-def log_affected_projects(pkg, **kwargs):
-    """Create log entries for all projects that require `pkg`."""
-    affected_projects = Project.objects.filter(dependencies__package=pkg) \
-                                       .values_list('id', flat=True)
+def log_affected_projects(packages, **kwargs):
+    """Create log entries for all projects that require one of `packages`.
+
+    :param packages: Mapping of package ids to the number of log entries
+                     to create for every project requiring that package.
+    """
+    dependencies = ProjectDependency.objects \
+        .filter(package__in=packages.keys()) \
+        .values_list('project', 'package')
 
     log_entries = []
-    for project in affected_projects:
-        # Add log entry for new package release
-        log = Log(project_id=project, **kwargs)
-        log_entries.append(log)
+    for project, package in dependencies:
+        for i in xrange(packages[package]):
+            log_entries.append(Log(project_id=project, package_id=package,
+                                   **kwargs))
     Log.objects.bulk_create(log_entries)
-    return affected_projects
+
+
+def get_tracked_packages():
+    """Return the names of all packages at least one project depends on."""
+    return set(Package.objects.filter(projectdependency__isnull=False)
+                              .values_list('name', flat=True).distinct())
+
+
+def get_or_create_packages(names, create=()):
+    """Return a ``{name: id}`` mapping for the known package `names`.
+
+    Known packages are resolved with one query, missing packages listed
+    in `create` are created with one bulk insert.
+    """
+    names = set(names)
+    if not names:
+        return {}
+    ids = dict(Package.objects.filter(name__in=names)
+                              .values_list('name', 'id'))
+    missing = set(create).difference(ids)
+    if missing:
+        Package.objects.bulk_create([Package.from_name(name)
+                                     for name in missing])
+        ids.update(Package.objects.filter(name__in=missing)
+                                  .values_list('name', 'id'))
+    return ids
+
+
+def apply_changes(changes):
+    """Apply a batch of compacted changelog entries.
+
+    Every package is written once, packages and versions end up the same
+    as after applying the underlying changelog events one after another.
+    Returns the ids of all released packages, their dependents have to be
+    checked for updates afterwards.
+
+    :param changes: List of :class:`~folivora.utils.changelog.PackageChanges`.
+    """
+    if not changes:
+        return set()
+
+    ids = get_or_create_packages((c.name for c in changes),
+                                 (c.name for c in changes if c.created))
+    changes = dict((ids[c.name], c) for c in changes if c.name in ids)
+
+    removed = dict((pkg, c.removes) for pkg, c in changes.iteritems()
+                   if c.removes)
+    wiped = [pkg for pkg, c in changes.iteritems() if c.wiped]
+    released = [pkg for pkg, c in changes.iteritems() if c.released]
+
+    if removed:
+        # We only clear versions and set the recent updated version
+        # on every project dependency to NULL. This way we can ensure
+        # stability on ProjectDependency.
+        ProjectDependency.objects.filter(package__in=removed.keys()) \
+                                 .update(update=None)
+        log_affected_projects(removed, action='remove_package',
+                              type='package')
+    if wiped:
+        # Clears `Package.latest_version` as well.
+        PackageVersion.objects.filter(package__in=wiped).delete()
+
+    if not released:
+        return set()
+
+    versions = set(v for pkg in released for v in changes[pkg].releases)
+    existing = {}
+    for pkg, version in PackageVersion.objects \
+            .filter(package__in=released, version__in=versions) \
+            .values_list('package', 'version'):
+        existing.setdefault(pkg, set()).add(version)
+
+    new_versions = []
+    for pkg in released:
+        for version, stamp in changes[pkg].new_versions(existing.get(pkg, ())):
+            dt = datetime.datetime.fromtimestamp(stamp)
+            new_versions.append(PackageVersion(
+                package_id=pkg, version=version,
+                release_date=timezone.make_aware(dt, pytz.UTC)))
+    PackageVersion.bulk_insert(new_versions)
+    return set(released)
+
+
+def apply_changelog(log):
+    """Compact and apply changelog events in batches.
+
+    Returns the ids of all released packages.
+    """
+    batch_size = getattr(settings, 'FOLIVORA_CHANGELOG_BATCH_SIZE', 500)
+    changes = compact_changelog(log)
+    if getattr(settings, 'FOLIVORA_TRACKED_ONLY', False):
+        # Skip everything no project depends on, the full catalog
+        # can be loaded with the load_catalog command.
+        tracked = get_tracked_packages()
+        changes = [c for name, c in changes.iteritems() if name in tracked]
+    else:
+        changes = changes.values()
+    packages = set()
+    for offset in xrange(0, len(changes), batch_size):
+        packages.update(apply_changes(changes[offset:offset + batch_size]))
+    return packages
+
+
+def queue_dependents(package_ids):
+    """Queue :func:`sync_dependents` for all `package_ids`.
+
+    The packages are split into chunks of ``FOLIVORA_SYNC_CHUNK_SIZE``,
+    the chunks are processed in parallel.
+    """
+    package_ids = list(package_ids)
+    if not package_ids:
+        return
+    chunk_size = getattr(settings, 'FOLIVORA_SYNC_CHUNK_SIZE', 20)
+    group([sync_dependents.s(package_ids[offset:offset + chunk_size])
+           for offset in xrange(0, len(package_ids), chunk_size)]) \
+        .apply_async()
 
 
 @task(max_retries=4, iterations=0)
 def sync_with_changelog():
     """Syncronize with pypi changelog.
 
+    Fetched events are written to the :class:`ChangelogEvent` journal and
+    applied by :func:`apply_journal`.
+
     Right now we only listen for `new-release`, `remove`, `rename`,
     and `create` as we do not store any metadata information.
 
@@ -58,116 +190,322 @@ def sync_with_changelog():
     """
     next_last_sync = timezone.now()
 
-    state, created = SyncState.objects.get_or_create(type=SyncState.CHANGELOG)
-
-    epoch = int(time.mktime(state.last_sync.timetuple()))
-
-    client = CheeseShop()
-
-    try:
-        log = client.get_changelog(epoch, True)
-    except socket.error as exc:
-        if current.iterations == current.max_retries:
+    client = get_pypi_client()
+
+    # The beat schedule and retries must not fetch the same window twice.
+    with advisory_lock(CHANGELOG_FETCH, 0):
+        state, created = SyncState.objects.get_or_create(
+            type=SyncState.CHANGELOG)
+        try:
+            if state.last_serial is None:
+                # No serial recorded yet, fall back to the timestamp once.
+                # The serial is queried first so that we rather process
+                # events twice than miss some.
+                serial = client.get_last_serial()
+                epoch = int(time.mktime(state.last_sync.timetuple()))
+                log = client.get_changelog(epoch, True)
+            else:
+                log = client.get_changelog_since_serial(state.last_serial)
+        except Unavailable as exc:
+            # PyPi is known to be down or overloaded, the next run tries
+            # again.
             SyncState.objects.filter(type=SyncState.CHANGELOG) \
                              .update(state=SyncState.STATE_DOWN)
-            logger.warning('No sync with PyPi, it\'s not reachable.')
+            logger.warning('No sync with PyPi, backing off for %d seconds.',
+                           exc.retry_after)
+            queue_pending_journal()
             return
-        else:
-            current.iterations += 1
-            current.retry(countdown=0, exc=exc)
-    else:
-        projects = set()
-        for package, version, stamp, action in log:
-            if action == 'new release':
-                try:
-                    pkg = Package.objects.get(name=package)
-                except Package.DoesNotExist:
-                    pkg = Package.create_with_provider_url(package)
-
-                dt = datetime.datetime.fromtimestamp(stamp)
-                release_date = timezone.make_aware(dt, pytz.UTC)
-                exists = PackageVersion.objects.filter(package=pkg,
-                                                       version=version).exists()
-                if not exists:
-                    update = PackageVersion(version=version,
-                                            release_date=release_date)
-                    pkg.versions.add(update)
-                    ProjectDependency.objects.filter(package=pkg) \
-                                             .update(update=update)
-
-                projects.update(Project.objects.filter(dependencies__package=pkg)
-                                               .values_list('id', flat=True))
-
-            elif action == 'remove':
-                # We only clear versions and set the recent updated version
-                # on every project dependency to NULL. This way we can ensure
-                # stability on ProjectDependency.
-                try:
-                    pkg = Package.objects.get(name=package)
-                    ProjectDependency.objects.filter(package=pkg) \
-                                             .update(update=None)
-
-                    if version is None:
-                        pkg.versions.all().delete()
-
-                    log_affected_projects(pkg, action='remove_package',
-                                          type='package', package=pkg)
-                except Package.DoesNotExist:
-                    pass
-
-            elif action == 'create':
-                if not Package.objects.filter(name=package).exists():
-                    Package.create_with_provider_url(package)
-
-        for project in projects:
-            sync_project.apply(args=(project,))
-
-        SyncState.objects.filter(type=SyncState.CHANGELOG) \
-                         .update(last_sync=next_last_sync,
-                                 state=SyncState.STATE_RUNNING)
+        except socket.error as exc:
+            if current.iterations == current.max_retries:
+                SyncState.objects.filter(type=SyncState.CHANGELOG) \
+                                 .update(state=SyncState.STATE_DOWN)
+                logger.warning('No sync with PyPi, it\'s not reachable.')
+                queue_pending_journal()
+                return
+            else:
+                current.iterations += 1
+                current.retry(countdown=0, exc=exc)
+
+        if state.last_serial is not None:
+            serial = max([state.last_serial] + [e[4] for e in log])
+        dropped = ()
+        if getattr(settings, 'FOLIVORA_TRACKED_ONLY', False):
+            # Nobody depends on the other packages, they never reach the
+            # journal.  The full catalog can be loaded with load_catalog.
+            tracked = get_tracked_packages()
+            dropped = set(e[0] for e in log if e[0] not in tracked)
+            log = [e for e in log if e[0] in tracked]
+
+        # The journal is the hand-off to the apply workers, it is written
+        # in the same transaction that records the new position.  After
+        # an outage the backlog is split up by the apply workers.
+        with transaction.commit_on_success():
+            write_journal(log)
+            if dropped:
+                # Their versions go stale, the next dependent syncs them
+                # from scratch.
+                Package.objects.filter(name__in=dropped,
+                                       initial_sync_done=True) \
+                               .update(initial_sync_done=False)
+            SyncState.objects.filter(type=SyncState.CHANGELOG) \
+                             .update(last_sync=next_last_sync,
+                                     last_serial=serial,
+                                     state=SyncState.STATE_RUNNING)
+
+    invalidate_packages(set(e[0] for e in log
+                            if e[3] in ('new release', 'remove')))
+
+    queue_pending_journal()
+
+
+def write_journal(log):
+    """Write changelog events to the journal.
+
+    Events are inserted in chunks of ``FOLIVORA_CHANGELOG_SLICE_SIZE``.
+    """
+    shards = getattr(settings, 'FOLIVORA_JOURNAL_SHARDS', 8)
+    size = getattr(settings, 'FOLIVORA_CHANGELOG_SLICE_SIZE', 10000)
+    for offset in xrange(0, len(log), size):
+        events = []
+        for event in log[offset:offset + size]:
+            name, version, stamp, action = event[:4]
+            serial = event[4] if len(event) > 4 else None
+            events.append(ChangelogEvent(
+                name=name, version=version, timestamp=stamp, action=action,
+                serial=serial, shard=ChangelogEvent.get_shard(name, shards)))
+        ChangelogEvent.objects.bulk_create(events)
+
+
+def queue_pending_journal():
+    """Queue :func:`apply_journal` for every shard with pending events.
+
+    Called on every changelog sync, so events left behind by a failed
+    apply worker are picked up by the next run.
+    """
+    shards = ChangelogEvent.objects.filter(applied=False) \
+                                   .values_list('shard', flat=True) \
+                                   .distinct()
+    for shard in shards:
+        apply_journal.delay(shard)
 
 
 @task
+def apply_journal(shard):
+    """Apply all pending journal events of `shard` in order.
+
+    Only one worker applies a shard at a time, others return right away.
+    Events are applied in batches of ``FOLIVORA_CHANGELOG_SLICE_SIZE``.
+    Old applied events are purged first, see :func:`purge_journal`.
+    """
+    size = getattr(settings, 'FOLIVORA_CHANGELOG_SLICE_SIZE', 10000)
+    pending = ChangelogEvent.objects.filter(shard=shard, applied=False) \
+                                    .order_by('id')
+    with try_advisory_lock(JOURNAL_SHARD, shard) as acquired:
+        if not acquired:
+            return
+        purge_journal(shard)
+        while True:
+            events = list(pending[:size])
+            if not events:
+                break
+            with transaction.commit_on_success():
+                packages = apply_changelog([e.event for e in events])
+            # The events are marked applied only once the dependents are
+            # handed off, after a crash in between they are applied again.
+            queue_dependents(packages)
+            ChangelogEvent.objects.filter(pk__in=[e.pk for e in events]) \
+                                  .update(applied=True)
+
+
+def purge_journal(shard):
+    """Delete the applied events of `shard` older than
+    ``FOLIVORA_JOURNAL_RETENTION`` days.
+
+    Only the remaining window can be replayed with :func:`replay_journal`.
+    """
+    days = getattr(settings, 'FOLIVORA_JOURNAL_RETENTION', 7)
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM folivora_changelogevent WHERE shard = %s '
+                   'AND applied AND timestamp < %s',
+                   [shard, int(time.time()) - days * 24 * 60 * 60])
+    transaction.commit_unless_managed()
+
+
+def replay_journal(first_serial, last_serial):
+    """Apply the journaled events between two serials (inclusive) again.
+
+    Meant for debugging and benchmarks, dependents are not checked and
+    removals create their log entries again.  Returns the ids of all
+    released packages.
+    """
+    events = ChangelogEvent.objects.filter(serial__gte=first_serial,
+                                           serial__lte=last_serial) \
+                                   .order_by('serial')
+    return apply_changelog([e.event for e in events])
+
+
+def backfill_versions(client, packages):
+    """Sync the versions of `packages` using a :class:`ConcurrentCheeseShop`.
+
+    Versions are requested with one multicall per `client.batch_size`
+    packages, all batches are sent before the first response is stored.
+    If PyPi reports an error for a batch, its packages are queried one by
+    one and those that fail again are skipped.  Only release urls of the
+    versions :meth:`Package.get_sync_since` asks for are requested.
+    Returns the number of synced packages.
+    """
+    packages = [p for p in packages if not p.initial_sync_done]
+    batches = [packages[offset:offset + client.batch_size]
+               for offset in xrange(0, len(packages), client.batch_size)]
+    pending = [(batch, client.get_multiple_package_versions(
+                   [package.name for package in batch]))
+               for batch in batches]
+    fetched = []
+    for batch, versions in pending:
+        try:
+            versions = versions.get()
+        except xmlrpclib.Fault as exc:
+            logger.warning('Batch failed, querying packages one by one: %s',
+                           exc)
+            versions = _fetch_versions_one_by_one(client, batch)
+        for package in batch:
+            if package.name not in versions:
+                continue
+            wanted = versions_since(versions[package.name],
+                                    package.get_sync_since())
+            fetched.append((package, versions[package.name],
+                client.get_multiple_release_urls(package.name, wanted)))
+    synced = 0
+    for package, versions, release_urls in fetched:
+        try:
+            release_urls = release_urls.get()
+        except xmlrpclib.Fault as exc:
+            logger.warning('Skipping %s: %s', package.name, exc)
+            continue
+        package.sync_versions(versions=versions, release_urls=release_urls)
+        synced += 1
+    return synced
+
+
+def _fetch_versions_one_by_one(client, packages):
+    pending = [(package, client.get_package_versions(package.name))
+               for package in packages]
+    versions = {}
+    for package, result in pending:
+        try:
+            versions[package.name] = result.get()
+        except xmlrpclib.Fault as exc:
+            logger.warning('Skipping %s: %s', package.name, exc)
+    return versions
+
+
+def update_dependencies(project_ids=None, package_ids=None):
+    """Check dependencies for available updates.
+
+    Either all dependencies of `project_ids` or all dependencies on
+    `package_ids` are checked.  Dependencies pinned to an older version
+    than the latest release point to that release afterwards, all others
+    are cleared.  The work is done in a constant number of queries,
+    independent of the number of projects and dependencies.  Returns a
+    dictionary mapping project ids to the (already saved)
+    `update_available` log entries.
+    """
+    if project_ids is not None:
+        lookup = {'project__in': list(project_ids)}
+    else:
+        lookup = {'package__in': list(package_ids)}
+
+    # Partially synced packages are widened if an older version is pinned,
+    # the lowest pins of all of them are looked up at once.
+    unsynced = list(Package.objects.filter(
+        Q(initial_sync_done=False) | Q(synced_from__isnull=False),
+        **dict(('projectdependency__' + k, v) for k, v in lookup.items())
+    ).distinct())
+    partial = [p.pk for p in unsynced if p.initial_sync_done]
+    pins = {}
+    if partial and getattr(settings, 'FOLIVORA_PARTIAL_SYNC', False):
+        pins = Package.get_lowest_pins(partial)
+    for package in unsynced:
+        if package.needs_sync(pins.get(package.pk)):
+            package.sync_versions()
+
+    dependencies = ProjectDependency.objects \
+        .filter(package__latest_version__isnull=False, **lookup) \
+        .values_list('id', 'project', 'package', 'version', 'update',
+                     'package__latest_version',
+                     'package__latest_version__version',
+                     'package__latest_version__sort_key',
+                     'package__latest_version__release_date')
+
+    current = []
+    outdated = []
+    updates = []
+    for (pk, project, package, version, update, latest, latest_version,
+         sort_key, release_date) in dependencies:
+        # The sort key orders like LooseVersion since at least pytz
+        # fails with StrictVersion
+        if version_sort_key(version) >= sort_key:
+            if update is not None:
+                current.append(pk)
+        elif update != latest:
+            outdated.append(pk)
+            updates.append((project, package, latest_version, release_date))
+
+    if current:
+        ProjectDependency.objects.filter(pk__in=current).update(update=None)
+    ProjectDependency.update_to_latest_versions(outdated)
+
+    packages = Package.objects.in_bulk(set(u[1] for u in updates))
+    log_entries = {}
+    tz = timezone.utc
+    for project, package, version, release_date in updates:
+        since = str(timezone.make_naive(release_date, tz))
+        log_entries.setdefault(project, []).append(
+            Log(type='project_dependency', action='update_available',
+                project_id=project, package=packages[package],
+                data={'version': version, 'since': since}))
+    Log.objects.bulk_create([l for e in log_entries.values() for l in e])
+    return log_entries
+
+
+@task(max_retries=10)
 def sync_project(project_pk):
     """Syncronize all dependencies of a project.
 
     This syncronizes all package versions and creates proper
     log entries on updates as well as starts the notification
-    routing.
+    routing.  While PyPi is unavailable the task is deferred.
     """
-    project = Project.objects.get(pk=project_pk)
-
-    log_entries = []
-    for dependency in project.dependencies.all():
-        package = dependency.package
-        package.sync_versions()
-        versions = list(package.versions.values_list('version', flat=True))
+    try:
+        log_entries = update_dependencies([project_pk])
+    except Unavailable as exc:
+        current.retry(countdown=exc.retry_after, exc=exc)
+    if log_entries:
+        project = Project.objects.get(pk=project_pk)
+        send_notifications(project, log_entries[project_pk])
 
-        if versions:
-            # We use LooseVersion since at least pytz fails with StrictVersion
-            # TODO: tests
-            versions.sort(key=LooseVersion)
 
-            if LooseVersion(dependency.version) >= LooseVersion(versions[-1]):
-                ProjectDependency.objects.filter(pk=dependency.pk) \
-                                         .update(update=None)
-                continue  # The dependency is up2date, nothing to do
+@task(max_retries=10)
+def sync_dependents(package_ids):
+    """Check all dependencies on `package_ids` for available updates.
 
-            pv = PackageVersion.objects.get(package=package,
-                                            version=versions[-1])
+    Called after new releases, the work is proportional to the number of
+    dependents of these packages.  While PyPi is unavailable the task is
+    deferred.
+    """
+    try:
+        log_entries = update_dependencies(package_ids=package_ids)
+    except Unavailable as exc:
+        current.retry(countdown=exc.retry_after, exc=exc)
+    for project, entries in log_entries.iteritems():
+        send_project_notifications.delay(project, entries)
 
-            if pv.pk == dependency.update_id:
-                continue
 
-            dependency.update = pv
-            dependency.save()
-            tz = timezone.utc
-            since = str(timezone.make_naive(pv.release_date, tz))
-            log_entries.append(Log(type='project_dependency',
-                                   action='update_available',
-                                   project=project, package=package,
-                                   data={'version': versions[-1],
-                                         'since': since}))
-    if log_entries:
-        Log.objects.bulk_create(log_entries)
-        send_notifications(project, log_entries)
+@task
+def send_project_notifications(project_pk, log_entries):
+    """Send notifications about `log_entries` to the project members."""
+    try:
+        project = Project.objects.get(pk=project_pk)
+    except Project.DoesNotExist:
+        return
+    send_notifications(project, log_entries)
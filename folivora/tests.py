@@ -1,5 +1,17 @@
+import os
+import gzip
+import json
+import shutil
 import socket
+import time
 import logging
+import tempfile
+import threading
+import xmlrpclib
+import SocketServer
+from contextlib import contextmanager
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from cStringIO import StringIO
 
 import pytz
 import mock
@@ -9,6 +21,7 @@ from datetime import datetime
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core import mail
+from django.core.management import call_command
 from django.test import TestCase
 from django.utils.timezone import make_aware
 from django.test.client import Client
@@ -17,9 +30,24 @@ from django.test.utils import override_settings
 from django.contrib.auth.models import User
 
 from .models import (Package, PackageVersion, Project, Log,
-    ProjectDependency, ProjectMember, SyncState)
+    ProjectDependency, ProjectMember, SyncState, ChangelogEvent, ServiceState)
 from . import tasks
+from .management.commands.load_catalog import load_package_names
+from .utils.changelog import compact_changelog
+from .utils.locks import CHANGELOG_FETCH
+from .utils.circuit import CircuitBreaker, CircuitOpen, RateLimited
+from .utils.clients import get_breaker, get_pypi_client, use_client
 from .utils.parsers import get_parser, BaseParser
+from .utils.pypi import (CheeseShop, ConcurrentCheeseShop, connection_pool,
+    get_server_stats, get_all_server_stats, normalize_name)
+from .utils.cache import cached_client, get_pypi_cache, invalidate_packages
+from .utils.benchmark import (populate, measure, local_tasks,
+    SyntheticCheeseShop)
+from .utils.recording import RecordingCheeseShop, ReplayCheeseShop
+from .utils.snapshot import (export_catalog, import_catalog, read_snapshot,
+    write_snapshot)
+from .utils.versions import version_sort_key, versions_since
+from .utils.mirror import FilesystemMirror
 from .utils.jabber import is_valid_jid
 from .utils.forms import JabberField
 from .utils.views import SortListMixin
@@ -36,6 +64,9 @@ class CheesyMock(object):
     def get_package_list(self):
         return ['pmxbot', 'gunicorn']
 
+    def get_last_serial(self):
+        return 42
+
     def get_changelog(self, hours, force=False):
         return [['pmxbot', '1101.8.1', 1345259834, 'new release'],
                 ['pmxbot2', '1101.8.1', 1345259834, 'new release'],
@@ -58,6 +89,9 @@ class CheesyMock(object):
                  'upload_time': datetime(2012, 8, 18, 3, 17, 15),
                  'url': 'http://pypi.python.org/packages/source/p/pmxbot/pmxbot-1101.8.1.zip'}]
 
+    def get_multiple_release_urls(self, name, versions):
+        return dict((v, self.get_release_urls(name, v)) for v in versions)
+
     def get_package_versions(self, name):
         if name in ('pmxbot', 'pmxbot2'):
             return ['1101.8.1']
@@ -67,12 +101,106 @@ class CheesyMock(object):
             return ['0']
 
 
+class BulkCheesyMock(CheesyMock):
+
+    def get_changelog(self, hours, force=False):
+        log = []
+        for idx in range(10):
+            name = 'bulk-%d' % idx
+            log.extend([[name, None, 1345259834, 'create'],
+                        [name, '0.1', 1345259834, 'new release'],
+                        [name, '0.2', 1345259835, 'new release'],
+                        [name, '0.2', 1345259836, 'new release']])
+        log.append(['pmxbot', '1101.8.2', 1345259837, 'new release'])
+        return log
+
+
+class RereleaseCheesyMock(CheesyMock):
+
+    def get_changelog(self, hours, force=False):
+        return [['pmxbot', '1101.8.2', 1345259834, 'new release'],
+                ['pmxbot', '1101.8.2', 1345259834, 'add source file'],
+                ['pmxbot', None, 1345259835, 'remove'],
+                ['pmxbot', '1101.8.3', 1345259836, 'new release'],
+                ['pmxbot', '1101.8.3', 1345259836, 'add source file']]
+
+
 class NotConnectedCheesyMock(object):
     def get_changelog(self, hours, force=False):
         err = socket.error()
         err.errno = 111
         raise err
 
+    def get_last_serial(self):
+        return self.get_changelog(0)
+
+
+class CountingRequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.server.connections += 1
+        SimpleXMLRPCRequestHandler.setup(self)
+
+    def do_POST(self):
+        self.server.requests += 1
+        self.server.authorizations.append(self.headers.get('Authorization'))
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+
+class ThreadingXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class XMLRPCTestServer(object):
+    """PyPi stand-in serving XML-RPC on a random local port."""
+
+    changelog = [['pmxbot', '1101.8.2', 1345259834, 'new release', 43],
+                 ['pmxbot', '1101.8.2', 1345259834, 'add source file', 44],
+                 ['new_package', '0.1', 1345259835, 'new release', 45]]
+
+    def __init__(self):
+        self.server = ThreadingXMLRPCServer(
+            ('127.0.0.1', 0), logRequests=False, allow_none=True,
+            requestHandler=CountingRequestHandler)
+        self.server.requests = 0
+        self.server.connections = 0
+        self.server.authorizations = []
+        self.server.register_multicall_functions()
+        self.server.register_function(self.changelog_last_serial)
+        self.server.register_function(self.changelog_since_serial)
+        self.server.register_function(self.package_releases)
+        self.server.register_function(self.release_urls)
+        self.calls = []
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def changelog_last_serial(self):
+        self.calls.append(('changelog_last_serial',))
+        return self.changelog[-1][4]
+
+    def changelog_since_serial(self, serial):
+        self.calls.append(('changelog_since_serial', serial))
+        return [e for e in self.changelog if e[4] > serial]
+
+    def package_releases(self, name):
+        self.calls.append(('package_releases', name))
+        return ['%s.%d' % (name, idx) for idx in range(3)]
+
+    def release_urls(self, name, version):
+        self.calls.append(('release_urls', name, version))
+        return [{'filename': '%s-%s.zip' % (name, version),
+                 'upload_time': datetime(2012, 8, 18, 3, 17, 15)}]
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        connection_pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
 
 def stub(*args, **kwargs):
     return
@@ -105,7 +233,7 @@ class TestPackageModel(TestCase):
         self.assertEqual(pkg.name, 'GuNiCoRn')
         self.assertEqual(pkg.normalized_name, 'gunicorn')
 
-    @mock.patch('folivora.models.CheeseShop', CheesyMock)
+    @mock.patch('folivora.models.get_pypi_client', CheesyMock)
     def test_version_sync(self):
         pkg = Package.objects.get(name='pmxbot')
         self.assertEqual(pkg.versions.count(), 0)
@@ -113,9 +241,31 @@ class TestPackageModel(TestCase):
         self.assertEqual(pkg.versions.count(), 1)
         version = pkg.versions.all()[0]
         self.assertEqual(version.version, '1101.8.1')
+        self.assertEqual(pkg.latest_version, version)
+        pkg = Package.objects.get(name='pmxbot')
+        self.assertEqual(pkg.latest_version, version)
         self.assertNumQueries(0, pkg.sync_versions)
 
-    @mock.patch('folivora.models.CheeseShop', CheesyMock)
+    @mock.patch('folivora.models.get_pypi_client', CheesyMock)
+    def test_version_sync_skips_existing_versions(self):
+        pkg = Package.objects.get(name='pmxbot')
+        dt = make_aware(datetime(2012, 7, 26, 23, 51, 18), pytz.UTC)
+        PackageVersion.objects.create(package=pkg, version='1101.8.1',
+                                      release_date=dt)
+        pkg.sync_versions()
+        self.assertEqual(pkg.versions.get().release_date, dt)
+        pkg = Package.objects.get(name='pmxbot')
+        self.assertTrue(pkg.initial_sync_done)
+
+    @mock.patch('folivora.models.get_pypi_client', NotConnectedCheesyMock)
+    def test_version_sync_done_by_other_worker(self):
+        pkg = Package.objects.get(name='pmxbot')
+        Package.objects.filter(pk=pkg.pk).update(initial_sync_done=True)
+        # Would raise a socket error if PyPi was queried.
+        pkg.sync_versions()
+        self.assertTrue(pkg.initial_sync_done)
+
+    @mock.patch('folivora.models.get_pypi_client', CheesyMock)
     def test_version_sync_without_versions(self):
         #Bug group/337798
         pkg = Package.objects.create(name='gunicorn',
@@ -144,6 +294,123 @@ class TestPackageVersionModel(TestCase):
         self.assertEqual(vers.release_date, dt)
 
 
+class TestVersionSortKey(TestCase):
+
+    def assertOrdered(self, *versions):
+        keys = map(version_sort_key, versions)
+        self.assertEqual(keys, sorted(keys))
+
+    def test_numeric_order(self):
+        self.assertOrdered('0.9', '1.4', '1.4.1', '1.9', '1.10', '10')
+
+    def test_numbers_before_strings(self):
+        self.assertOrdered('1.0', '1.0a1', '1.0b2', '1.0rc1')
+        self.assertOrdered('2012a', '2012d')
+
+    def test_equal_versions(self):
+        self.assertEqual(version_sort_key('1.07'), version_sort_key('1.7'))
+
+    def test_latest_version(self):
+        pkg = Package.create_with_provider_url('pmxbot')
+        self.assertEqual(pkg.get_latest_version(), None)
+        dt = make_aware(datetime(2012, 7, 26, 23, 51, 18), pytz.UTC)
+        PackageVersion.bulk_insert([
+            PackageVersion(package=pkg, version=v, release_date=dt)
+            for v in ('1.9', '1.10', '1.1')])
+        PackageVersion.objects.create(package=pkg, version='1.2',
+                                      release_date=dt)
+        self.assertEqual(pkg.get_latest_version().version, '1.10')
+        newer = pkg.versions.filter(sort_key__gt=version_sort_key('1.2'))
+        self.assertEqual(newer.count(), 2)
+
+
+class HistoryCheesyMock(CheesyMock):
+
+    def __init__(self):
+        self.requested = []
+
+    def get_package_versions(self, name):
+        return ['1.0', '1.1', '1.2', '1.10', '2.0']
+
+    def get_multiple_release_urls(self, name, versions):
+        self.requested.extend(versions)
+        return super(HistoryCheesyMock, self).get_multiple_release_urls(
+            name, versions)
+
+
+@override_settings(FOLIVORA_PARTIAL_SYNC=True)
+class TestPartialSync(TestCase):
+
+    def setUp(self):
+        self.client = HistoryCheesyMock()
+        self.package = Package.create_with_provider_url('pmxbot')
+        self.project = Project.objects.create(name='test', slug='test')
+        ProjectDependency.objects.create(project=self.project,
+                                         package=self.package, version='1.2')
+
+    def stored_versions(self):
+        return sorted(self.package.versions.values_list('version', flat=True),
+                      key=version_sort_key)
+
+    def test_versions_since(self):
+        versions = ['1.0', '1.10', '1.2', '2.0b1']
+        self.assertEqual(versions_since(versions, None), versions)
+        self.assertEqual(versions_since(versions, '1.2'),
+                         ['1.10', '1.2', '2.0b1'])
+        self.assertEqual(versions_since(versions, '3.0'), ['2.0b1'])
+        self.assertEqual(versions_since([], '1.0'), [])
+
+    def test_only_pinned_and_newer_versions_are_fetched(self):
+        self.package.sync_versions(self.client)
+        self.assertEqual(self.client.requested, ['1.2', '1.10', '2.0'])
+        self.assertEqual(self.stored_versions(), ['1.2', '1.10', '2.0'])
+        package = Package.objects.get(pk=self.package.pk)
+        self.assertEqual(package.synced_from, '1.2')
+        self.assertEqual(package.latest_version.version, '2.0')
+
+    def test_history_is_widened_for_older_pins(self):
+        self.package.sync_versions(self.client)
+        other = Project.objects.create(name='other', slug='other')
+        ProjectDependency.objects.create(project=other, package=self.package,
+                                         version='1.1')
+        self.client.requested = []
+        self.package.sync_versions(self.client)
+        self.assertEqual(self.client.requested, ['1.1'])
+        self.assertEqual(self.stored_versions(),
+                         ['1.1', '1.2', '1.10', '2.0'])
+        self.assertEqual(self.package.synced_from, '1.1')
+
+    def test_newer_pins_need_no_requests(self):
+        self.package.sync_versions(self.client)
+        ProjectDependency.objects.update(version='1.10')
+        self.client.requested = []
+        self.package.sync_versions(self.client)
+        self.assertEqual(self.client.requested, [])
+        self.assertEqual(self.package.synced_from, '1.2')
+
+    def test_full_history_without_partial_sync(self):
+        self.package.sync_versions(self.client)
+        with self.settings(FOLIVORA_PARTIAL_SYNC=False):
+            self.package.sync_versions(self.client)
+        self.assertEqual(self.client.requested,
+                         ['1.2', '1.10', '2.0', '1.0', '1.1'])
+        self.assertEqual(Package.objects.get(pk=self.package.pk).synced_from,
+                         None)
+        self.assertNumQueries(0, self.package.sync_versions)
+
+    def test_update_dependencies_widens_history(self):
+        self.package.sync_versions(self.client)
+        ProjectDependency.objects.update(version='1.0')
+        with mock.patch('folivora.models.get_pypi_client',
+                        mock.Mock(return_value=self.client)):
+            tasks.update_dependencies([self.project.pk])
+        self.assertEqual(self.stored_versions(),
+                         ['1.0', '1.1', '1.2', '1.10', '2.0'])
+        dependency = ProjectDependency.objects.get()
+        self.assertEqual(dependency.update.version, '2.0')
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True)
 class TestChangelogSync(TestCase):
 
     def setUp(self):
@@ -167,7 +434,7 @@ class TestChangelogSync(TestCase):
             package=pkg2,
             version='0.14.6')
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_new_release_sync(self):
         result = tasks.sync_with_changelog.apply(throw=True)
@@ -178,7 +445,7 @@ class TestChangelogSync(TestCase):
         self.assertEqual(pkg.versions.count(), 1)
         self.assertEqual(len(mail.outbox), 1)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_new_release_sync_creates_package_on_unknown_package(self):
         result = tasks.sync_with_changelog.apply(throw=True)
@@ -189,7 +456,7 @@ class TestChangelogSync(TestCase):
         self.assertEqual(pkg.versions.count(), 1)
         self.assertEqual(len(mail.outbox), 1)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_new_release_sync_dependency_update(self):
         result = tasks.sync_with_changelog.apply(throw=True)
@@ -201,7 +468,7 @@ class TestChangelogSync(TestCase):
         self.assertTrue(dep.update_available)
         self.assertEqual(len(mail.outbox), 1)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_new_release_sync_log_creation(self):
         result = tasks.sync_with_changelog.apply(throw=True)
@@ -210,7 +477,7 @@ class TestChangelogSync(TestCase):
         self.assertEqual(qs.count(), 1)
         self.assertEqual(len(mail.outbox), 1)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_package_removal_sync(self):
         result = tasks.sync_with_changelog.apply(throw=True)
@@ -222,7 +489,7 @@ class TestChangelogSync(TestCase):
         self.assertEqual(dep.update, None)
         self.assertFalse(dep.update_available)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_package_removal_sync_log_creation(self):
         result = tasks.sync_with_changelog.apply(throw=True)
@@ -230,7 +497,7 @@ class TestChangelogSync(TestCase):
         qs = Log.objects.filter(project=self.project, action='remove_package')
         self.assertEqual(qs.count(), 1)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_package_removal_sync_delete_versions(self):
         pkg = Package.create_with_provider_url('gunicorn-del')
@@ -245,8 +512,9 @@ class TestChangelogSync(TestCase):
 
         pkg = Package.objects.get(name='gunicorn-del')
         self.assertEqual(pkg.versions.count(), 0)
+        self.assertEqual(pkg.latest_version, None)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_package_removal_sync_delete_versions_preserve_dependencies(self):
         pkg = Package.create_with_provider_url('gunicorn-del')
@@ -266,7 +534,7 @@ class TestChangelogSync(TestCase):
         self.assertEqual(expected, dep)
         self.assertEqual(expected.update, None)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_package_version_filter_on_package(self):
         # Test that PackageVersion will be filtered properly
@@ -276,7 +544,258 @@ class TestChangelogSync(TestCase):
         pkg = Package.objects.get(name='pmxbot2')
         self.assertEqual(pkg.versions.count(), 1)
 
-    @mock.patch('folivora.tasks.CheeseShop', NotConnectedCheesyMock)
+    @override_settings(FOLIVORA_CHANGELOG_BATCH_SIZE=3)
+    @mock.patch('folivora.tasks.get_pypi_client', BulkCheesyMock)
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_new_release_sync_in_batches(self):
+        result = tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(result.successful())
+        packages = Package.objects.filter(name__startswith='bulk-')
+        self.assertEqual(packages.count(), 10)
+        for pkg in packages:
+            self.assertEqual(pkg.normalized_name, pkg.name)
+            self.assertEqual(sorted(pkg.versions.values_list('version',
+                                                             flat=True)),
+                             ['0.1', '0.2'])
+        dep = ProjectDependency.objects.get(package__name='pmxbot')
+        self.assertEqual(dep.update.version, '1101.8.2')
+
+    @mock.patch('folivora.tasks.get_pypi_client', RereleaseCheesyMock)
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_package_removal_and_rerelease(self):
+        result = tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(result.successful())
+        pkg = Package.objects.get(name='pmxbot')
+        self.assertEqual(list(pkg.versions.values_list('version', flat=True)),
+                         ['1101.8.3'])
+        self.assertEqual(pkg.latest_version.version, '1101.8.3')
+        dep = ProjectDependency.objects.get(package=pkg)
+        self.assertEqual(dep.update.version, '1101.8.3')
+        qs = Log.objects.filter(project=self.project, action='remove_package')
+        self.assertEqual(qs.count(), 1)
+
+    @override_settings(FOLIVORA_SYNC_CHUNK_SIZE=5, FOLIVORA_JOURNAL_SHARDS=1)
+    @mock.patch('folivora.tasks.get_pypi_client', BulkCheesyMock)
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_dependents_fan_out(self):
+        with mock.patch.object(tasks.sync_dependents, 's') as signature:
+            with mock.patch('folivora.tasks.group') as group:
+                result = tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(result.successful())
+        # 11 released packages, split into chunks of 5
+        chunks = [c[0][0] for c in signature.call_args_list]
+        self.assertEqual(map(len, chunks), [5, 5, 1])
+        self.assertEqual(len(set(sum(chunks, []))), 11)
+        self.assertTrue(group.return_value.apply_async.called)
+
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_new_release_notifies_dependents(self):
+        dt = make_aware(datetime(2012, 7, 26, 23, 51, 18), pytz.UTC)
+        PackageVersion.objects.create(package=self.pkg2, version='1.0',
+                                      release_date=dt)
+        ProjectDependency.objects.create(project=self.project,
+                                         package=self.pkg2, version='0.9')
+        result = tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(result.successful())
+        # pmxbot2 1101.8.1 is new, pmxbot 1101.8.1 was already known
+        qs = Log.objects.filter(project=self.project, action='update_available')
+        self.assertEqual(sorted(qs.values_list('package__name', flat=True)),
+                         ['pmxbot', 'pmxbot2'])
+        dep = ProjectDependency.objects.get(package=self.pkg2)
+        self.assertEqual(dep.update.version, '1101.8.1')
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(FOLIVORA_CHANGELOG_SLICE_SIZE=1)
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_sync_backlog(self):
+        server = XMLRPCTestServer()
+        server.start()
+        self.addCleanup(server.stop)
+        SyncState.objects.create(type=SyncState.CHANGELOG, last_serial=43,
+                                 state=SyncState.STATE_DOWN)
+        with mock.patch('folivora.tasks.get_pypi_client',
+                        lambda: CheeseShop(server.url)):
+            with mock.patch('folivora.tasks.advisory_lock',
+                            wraps=tasks.advisory_lock) as lock:
+                with mock.patch.object(ChangelogEvent.objects, 'bulk_create',
+                        wraps=ChangelogEvent.objects.bulk_create) as insert:
+                    result = tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(result.successful())
+        # The backlog is fetched once and journaled in chunks, the apply
+        # workers split it up further.
+        self.assertEqual(server.calls, [('changelog_since_serial', 43)])
+        self.assertEqual(insert.call_count, 2)
+        lock.assert_any_call(CHANGELOG_FETCH, 0)
+        self.assertEqual(ChangelogEvent.objects.filter(applied=True).count(),
+                         2)
+        state = SyncState.objects.get(type=SyncState.CHANGELOG)
+        self.assertEqual(state.last_serial, 45)
+        self.assertEqual(state.state, SyncState.STATE_RUNNING)
+        self.assertTrue(Package.objects.filter(name='new_package').exists())
+
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_changelog_journal(self):
+        result = tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(result.successful())
+        self.assertEqual(ChangelogEvent.objects.count(), 6)
+        self.assertFalse(ChangelogEvent.objects.filter(applied=False).exists())
+        event = ChangelogEvent.objects.get(name='new_package')
+        self.assertEqual(event.event,
+                         ('new_package', '0.1', 1345259834, 'new release',
+                          None))
+
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_failed_hand_off_applies_events_again(self):
+        shard = ChangelogEvent.get_shard('pmxbot', 8)
+        ChangelogEvent.objects.create(name='pmxbot', version='1101.8.2',
+                                      timestamp=1345259834, serial=50,
+                                      action='new release', shard=shard)
+        with mock.patch('folivora.tasks.queue_dependents',
+                        side_effect=socket.error):
+            result = tasks.apply_journal.apply(args=(shard,))
+        self.assertFalse(result.successful())
+        self.assertFalse(ChangelogEvent.objects.get(serial=50).applied)
+        with mock.patch('folivora.tasks.queue_dependents') as queue:
+            tasks.apply_journal.apply(args=(shard,), throw=True)
+        queue.assert_called_once_with(set([self.pkg.pk]))
+        self.assertTrue(ChangelogEvent.objects.get(serial=50).applied)
+
+    @override_settings(FOLIVORA_TRACKED_ONLY=True)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
+    def test_untracked_package_is_synced_again(self):
+        Package.objects.update(initial_sync_done=True)
+        with mock.patch.object(Package, 'sync_versions',
+                               autospec=True) as sync:
+            tasks.sync_with_changelog.apply(throw=True)
+            # The release of pmxbot2 was dropped, its versions are stale
+            self.assertFalse(Package.objects.get(
+                pk=self.pkg2.pk).initial_sync_done)
+            sync.reset_mock()
+            ProjectDependency.objects.create(project=self.project,
+                                             package=self.pkg2,
+                                             version='1.0')
+            tasks.update_dependencies(project_ids=[self.project.pk])
+        self.assertEqual([c[0][0].name for c in sync.call_args_list],
+                         ['pmxbot2'])
+
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_next_sync_applies_pending_events(self):
+        server = XMLRPCTestServer()
+        server.start()
+        self.addCleanup(server.stop)
+        SyncState.objects.create(type=SyncState.CHANGELOG, last_serial=45)
+        ChangelogEvent.objects.create(name='pmxbot', version='1101.8.2',
+                                      timestamp=1345259834, serial=40,
+                                      action='new release',
+                                      shard=ChangelogEvent.get_shard('pmxbot',
+                                                                     8))
+        # No new events, the shard is applied anyway
+        with mock.patch('folivora.tasks.get_pypi_client',
+                        lambda: CheeseShop(server.url)):
+            tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(ChangelogEvent.objects.get(serial=40).applied)
+        dep = ProjectDependency.objects.get(package=self.pkg)
+        self.assertEqual(dep.update.version, '1101.8.2')
+
+    def test_busy_shard_is_skipped(self):
+        shard = ChangelogEvent.get_shard('pmxbot', 8)
+        ChangelogEvent.objects.create(name='pmxbot', version='1101.8.2',
+                                      timestamp=1345259834, serial=50,
+                                      action='new release', shard=shard)
+
+        @contextmanager
+        def busy(namespace, key):
+            yield False
+        with mock.patch('folivora.tasks.try_advisory_lock', busy):
+            with mock.patch('folivora.tasks.apply_changelog') as apply:
+                tasks.apply_journal.apply(args=(shard,), throw=True)
+        self.assertFalse(apply.called)
+        self.assertFalse(ChangelogEvent.objects.get(serial=50).applied)
+
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_apply_pending_journal_events(self):
+        shard = ChangelogEvent.get_shard('pmxbot', 8)
+        ChangelogEvent.objects.create(name='pmxbot', version='1101.8.2',
+                                      timestamp=1345259834, serial=50,
+                                      action='new release', shard=shard)
+        result = tasks.apply_journal.apply(args=(shard,), throw=True)
+        self.assertTrue(result.successful())
+        self.assertTrue(ChangelogEvent.objects.get(serial=50).applied)
+        dep = ProjectDependency.objects.get(package=self.pkg)
+        self.assertEqual(dep.update.version, '1101.8.2')
+
+        # Replaying the window restores the versions
+        ProjectDependency.objects.update(update=None)
+        self.pkg.versions.filter(version='1101.8.2').delete()
+        self.assertEqual(tasks.replay_journal(50, 50), set([self.pkg.pk]))
+        self.assertTrue(self.pkg.versions.filter(version='1101.8.2').exists())
+
+    @override_settings(FOLIVORA_TRACKED_ONLY=True)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_tracked_only(self):
+        result = tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(result.successful())
+        self.assertFalse(Package.objects.filter(name__in=[
+            'new_package', 'created package']).exists())
+        self.assertFalse(self.pkg2.versions.exists())
+        # Tracked packages are still processed
+        qs = Log.objects.filter(project=self.project)
+        self.assertEqual(qs.filter(action='update_available').count(), 1)
+        self.assertEqual(qs.filter(action='remove_package').count(), 1)
+        state = SyncState.objects.get(type=SyncState.CHANGELOG)
+        self.assertEqual(state.last_serial, 42)
+        # Untracked events are not even journaled
+        self.assertEqual(sorted(set(ChangelogEvent.objects.values_list(
+            'name', flat=True))), ['gunicorn', 'pmxbot'])
+
+    @override_settings(FOLIVORA_JOURNAL_RETENTION=1)
+    def test_purge_journal(self):
+        shard = ChangelogEvent.get_shard('pmxbot', 8)
+        old = int(time.time()) - 2 * 24 * 60 * 60
+        for serial, stamp, applied in [(1, old, True), (2, old, False),
+                                       (3, int(time.time()), True)]:
+            ChangelogEvent.objects.create(name='pmxbot', version='1.0',
+                                          timestamp=stamp, serial=serial,
+                                          action='docupdate', shard=shard,
+                                          applied=applied)
+        tasks.purge_journal(shard)
+        self.assertEqual(sorted(ChangelogEvent.objects.values_list(
+            'serial', flat=True)), [2, 3])
+
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_initial_sync_records_serial(self):
+        result = tasks.sync_with_changelog.apply(throw=True)
+        self.assertTrue(result.successful())
+        state = SyncState.objects.get(type=SyncState.CHANGELOG)
+        self.assertEqual(state.last_serial, 42)
+
+    @mock.patch('folivora.models.Package.sync_versions', stub)
+    def test_sync_since_serial(self):
+        server = XMLRPCTestServer()
+        server.start()
+        self.addCleanup(server.stop)
+        SyncState.objects.create(type=SyncState.CHANGELOG, last_serial=43)
+        with mock.patch('folivora.tasks.get_pypi_client',
+                        lambda: CheeseShop(server.url)):
+            result = tasks.sync_with_changelog.apply(throw=True)
+            self.assertTrue(result.successful())
+            # A second run must not fetch anything already processed
+            result = tasks.sync_with_changelog.apply(throw=True)
+            self.assertTrue(result.successful())
+        self.assertEqual(server.calls, [('changelog_since_serial', 43),
+                                        ('changelog_since_serial', 45)])
+        state = SyncState.objects.get(type=SyncState.CHANGELOG)
+        self.assertEqual(state.last_serial, 45)
+        self.assertTrue(Package.objects.filter(name='new_package').exists())
+        # pmxbot 1101.8.2 was released before serial 43
+        self.assertFalse(PackageVersion.objects.filter(
+            package__name='pmxbot', version='1101.8.2').exists())
+
+    @mock.patch('folivora.tasks.get_pypi_client', NotConnectedCheesyMock)
     @mock.patch('folivora.tasks.logger', test_logger)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_retry_sync_changelog_on_connection_error(self):
@@ -290,7 +809,7 @@ class TestChangelogSync(TestCase):
         state = SyncState.objects.get(type=SyncState.CHANGELOG)
         self.assertEqual(state.state, SyncState.STATE_DOWN)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_sync_state_to_running_after_failure(self):
         state, created = SyncState.objects.get_or_create(type=SyncState.CHANGELOG)
@@ -301,7 +820,7 @@ class TestChangelogSync(TestCase):
         state = SyncState.objects.get(type=SyncState.CHANGELOG)
         self.assertEqual(state.state, SyncState.STATE_RUNNING)
 
-    @mock.patch('folivora.tasks.CheeseShop', CheesyMock)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
     @mock.patch('folivora.models.Package.sync_versions', stub)
     def test_package_create(self):
         result = tasks.sync_with_changelog.apply(throw=True)
@@ -309,6 +828,616 @@ class TestChangelogSync(TestCase):
         self.assertTrue(Package.objects.filter(name='created package').exists())
 
 
+class TestCheeseShop(TestCase):
+
+    def setUp(self):
+        self.server = XMLRPCTestServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def test_multiple_package_versions(self):
+        client = CheeseShop(self.server.url, batch_size=2)
+        versions = client.get_multiple_package_versions(['a', 'b', 'c'])
+        self.assertEqual(versions, {'a': ['a.0', 'a.1', 'a.2'],
+                                    'b': ['b.0', 'b.1', 'b.2'],
+                                    'c': ['c.0', 'c.1', 'c.2']})
+        self.assertEqual(self.server.server.requests, 2)
+
+    def test_multiple_release_urls(self):
+        client = CheeseShop(self.server.url, batch_size=10)
+        urls = client.get_multiple_release_urls('a', ['1.0', '2.0'])
+        self.assertEqual(urls['2.0'][0]['filename'], 'a-2.0.zip')
+        self.assertEqual(len(self.server.calls), 2)
+        self.assertEqual(self.server.server.requests, 1)
+
+    def test_connections_are_reused(self):
+        for idx in range(3):
+            client = CheeseShop(self.server.url, batch_size=2)
+            client.get_package_versions('a')
+            client.get_multiple_package_versions(['a', 'b', 'c'])
+        self.assertEqual(self.server.server.requests, 9)
+        self.assertEqual(self.server.server.connections, 1)
+
+    def test_authorization_on_reused_connections(self):
+        url = self.server.url.replace('http://', 'http://user:pw@')
+        for idx in range(3):
+            CheeseShop(url).get_package_versions('a')
+        self.assertEqual(self.server.server.connections, 1)
+        self.assertEqual(self.server.server.authorizations,
+                         ['Basic dXNlcjpwdw=='] * 3)
+
+    @override_settings(FOLIVORA_PYPI_TIMEOUT=5)
+    def test_timeout_setting(self):
+        client = get_pypi_client(self.server.url)
+        stats, proxy = client.xmlrpc.servers[0]
+        self.assertEqual(proxy._ServerProxy__transport.timeout, 5)
+
+    @override_settings(FOLIVORA_PYPI_BATCH_SIZE=2)
+    def test_batch_size_setting(self):
+        client = get_pypi_client(self.server.url)
+        self.assertEqual(client.batch_size, 2)
+        client.get_multiple_package_versions(['a', 'b', 'c'])
+        self.assertEqual(self.server.server.requests, 2)
+
+    def test_version_sync_uses_multicall(self):
+        pkg = Package.create_with_provider_url('pmxbot')
+        with mock.patch('folivora.models.get_pypi_client',
+                        lambda: CheeseShop(self.server.url)):
+            pkg.sync_versions()
+        self.assertEqual(pkg.versions.count(), 3)
+        # One call for the versions, one batch for all release urls
+        self.assertEqual(self.server.server.requests, 2)
+
+
+@override_settings(FOLIVORA_PYPI_CACHE='pypi', CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'pypi': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+             'LOCATION': 'folivora-tests'}})
+class TestPypiCache(TestCase):
+
+    def setUp(self):
+        get_pypi_cache().clear()
+        self.client = mock.Mock(wraps=CheesyMock())
+        self.cached = cached_client(self.client)
+
+    def test_package_versions_are_cached(self):
+        self.assertEqual(self.cached.get_package_versions('pmxbot'),
+                         ['1101.8.1'])
+        self.assertEqual(self.cached.get_package_versions('pmxbot'),
+                         ['1101.8.1'])
+        self.assertEqual(self.client.get_package_versions.call_count, 1)
+
+    def test_only_missing_release_urls_are_fetched(self):
+        self.cached.get_release_urls('pmxbot', '1.0')
+        urls = self.cached.get_multiple_release_urls('pmxbot', ['1.0', '2.0'])
+        self.assertEqual(sorted(urls), ['1.0', '2.0'])
+        self.client.get_multiple_release_urls.assert_called_with(
+            'pmxbot', ['2.0'])
+
+    def test_invalidate_packages(self):
+        self.cached.get_package_versions('pmxbot')
+        self.cached.get_package_versions('pytz')
+        invalidate_packages(['pmxbot'])
+        self.cached.get_package_versions('pmxbot')
+        self.cached.get_package_versions('pytz')
+        self.assertEqual(self.client.get_package_versions.call_count, 3)
+
+    @override_settings(CELERY_ALWAYS_EAGER=True)
+    @mock.patch('folivora.tasks.get_pypi_client', CheesyMock)
+    def test_changelog_invalidates_released_packages(self):
+        self.cached.get_package_versions('pmxbot')
+        self.cached.get_package_versions('pytz')
+        tasks.sync_with_changelog.apply(throw=True)
+        self.cached.get_package_versions('pmxbot')
+        self.cached.get_package_versions('pytz')
+        self.assertEqual(self.client.get_package_versions.call_count, 3)
+
+    def test_disabled_without_setting(self):
+        with override_settings(FOLIVORA_PYPI_CACHE=None):
+            self.assertIs(cached_client(self.client), self.client)
+
+
+@override_settings(FOLIVORA_PYPI_RATE=1, FOLIVORA_PYPI_BURST=2,
+                   FOLIVORA_PYPI_MAX_WAIT=0, FOLIVORA_PYPI_RESET_TIMEOUT=60,
+                   FOLIVORA_PYPI_FAILURE_THRESHOLD=2)
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('test')
+
+    @mock.patch('folivora.utils.circuit.time.time', lambda: 1000.0)
+    def test_rate_limit(self):
+        self.breaker.acquire()
+        self.breaker.acquire()
+        self.assertRaises(RateLimited, self.breaker.acquire)
+
+    def test_circuit_opens_after_failures(self):
+        for idx in range(2):
+            self.breaker.acquire()
+            self.breaker.failure()
+        self.assertRaises(CircuitOpen, self.breaker.acquire)
+        state = ServiceState.objects.get(name='test')
+        self.assertEqual(state.failures, 2)
+        self.assertEqual(state.rate, 0.25)
+
+    def test_single_probe_closes_circuit(self):
+        with mock.patch('folivora.utils.circuit.time.time', lambda: 1000.0):
+            self.breaker.acquire()
+            self.breaker.failure()
+            self.breaker.failure()
+        with mock.patch('folivora.utils.circuit.time.time', lambda: 1100.0):
+            self.breaker.acquire()
+            # Everybody else waits for the outcome of the probe
+            self.assertRaises(CircuitOpen, CircuitBreaker('test').acquire)
+            self.breaker.success()
+            CircuitBreaker('test').acquire()
+        self.assertEqual(ServiceState.objects.get(name='test').failures, 0)
+
+    def test_transport_reports_failures(self):
+        server = XMLRPCTestServer()
+        url = server.url
+        server.server.server_close()
+        client = CheeseShop(url, get_guard=lambda url: self.breaker)
+        self.assertRaises(socket.error, client.get_last_serial)
+        self.assertEqual(ServiceState.objects.get(name='test').failures, 1)
+
+    @mock.patch('folivora.tasks.update_dependencies')
+    def test_sync_project_is_deferred(self, update_dependencies):
+        update_dependencies.side_effect = CircuitOpen(30)
+        with override_settings(CELERY_ALWAYS_EAGER=True):
+            result = tasks.sync_project.apply(args=(1,))
+        self.assertIsInstance(result.result, CircuitOpen)
+        self.assertEqual(update_dependencies.call_count, 11)
+
+    @mock.patch('folivora.tasks.get_pypi_client')
+    def test_changelog_sync_backs_off(self, get_pypi_client):
+        get_pypi_client().get_last_serial.side_effect = CircuitOpen(30)
+        tasks.sync_with_changelog.apply(throw=True)
+        state = SyncState.objects.get(type=SyncState.CHANGELOG)
+        self.assertEqual(state.state, SyncState.STATE_DOWN)
+
+
+class TestRecording(TestCase):
+
+    def setUp(self):
+        self.server = XMLRPCTestServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        fd, self.fixture = tempfile.mkstemp(suffix='.xml.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, self.fixture)
+
+    def record(self):
+        client = RecordingCheeseShop(self.server.url, batch_size=2)
+        log = client.get_changelog_since_serial(42)
+        versions = client.get_multiple_package_versions(['pmxbot'])
+        urls = client.get_multiple_release_urls('pmxbot', versions['pmxbot'])
+        client.save(self.fixture)
+        return log, versions, urls
+
+    def test_replay_recorded_responses(self):
+        log, versions, urls = self.record()
+        requests = self.server.server.requests
+
+        client = ReplayCheeseShop(self.fixture)
+        self.assertEqual(client.get_recorded_changelog(),
+                         ('changelog_since_serial', [42], log))
+        self.assertEqual(client.get_changelog_since_serial(42), log)
+        self.assertEqual(client.get_package_versions('pmxbot'),
+                         versions['pmxbot'])
+        self.assertEqual(
+            client.get_multiple_release_urls('pmxbot', versions['pmxbot']),
+            urls)
+        self.assertEqual(self.server.server.requests, requests)
+
+    def test_unrecorded_call(self):
+        self.record()
+        client = ReplayCheeseShop(self.fixture)
+        self.assertRaises(xmlrpclib.Fault, client.get_changelog_since_serial, 0)
+
+    def test_version_sync_from_fixture(self):
+        self.record()
+        client = ReplayCheeseShop(self.fixture)
+        pkg = Package.create_with_provider_url('pmxbot')
+        with mock.patch('folivora.models.get_pypi_client', lambda: client):
+            pkg.sync_versions()
+        self.assertEqual(pkg.versions.count(), 3)
+
+
+class TestBenchmarkHelpers(TestCase):
+
+    def test_populate(self):
+        populate(packages=5, versions=3, projects=2, dependencies=4)
+        self.assertEqual(Package.objects.count(), 5)
+        self.assertEqual(PackageVersion.objects.count(), 15)
+        self.assertEqual(ProjectDependency.objects.count(), 8)
+        project = Project.objects.get(slug='project-0')
+        self.assertEqual(list(project.owners()),
+                         [User.objects.get(username='benchmark')])
+
+    def test_measure(self):
+        populate(packages=5, versions=3, projects=1, dependencies=1)
+        result, stats = measure(lambda: list(PackageVersion.objects.all()))
+        self.assertEqual(len(result), 15)
+        self.assertEqual(stats['queries'], 1)
+        self.assertEqual(stats['rows'], 15)
+        self.assertTrue(stats['peak_memory_increase'] >= 0)
+
+    def test_local_tasks(self):
+        eager = getattr(settings, 'CELERY_ALWAYS_EAGER', False)
+        backend = settings.EMAIL_BACKEND
+        with local_tasks():
+            self.assertTrue(settings.CELERY_ALWAYS_EAGER)
+            self.assertEqual(settings.EMAIL_BACKEND,
+                             'django.core.mail.backends.locmem.EmailBackend')
+        self.assertEqual(getattr(settings, 'CELERY_ALWAYS_EAGER', False),
+                         eager)
+        self.assertEqual(settings.EMAIL_BACKEND, backend)
+
+    def test_synthetic_changelog(self):
+        populate(packages=5, versions=3, projects=1, dependencies=5)
+        SyncState.objects.create(type=SyncState.CHANGELOG, last_serial=0)
+        with use_client(SyntheticCheeseShop(2)) as client:
+            self.assertIs(get_pypi_client(), client)
+            with local_tasks():
+                tasks.sync_with_changelog.apply()
+        self.assertIsInstance(get_pypi_client(), CheeseShop)
+        self.assertEqual(PackageVersion.objects.filter(version='2.0').count(),
+                         2)
+        self.assertEqual(ProjectDependency.objects.filter(
+            update__version='2.0').count(), 2)
+
+
+class TestMirrors(TestCase):
+
+    def setUp(self):
+        self.mirror = XMLRPCTestServer()
+        self.mirror.start()
+        self.pypi = XMLRPCTestServer()
+        self.pypi.start()
+        self.addCleanup(self.pypi.stop)
+        self.client = CheeseShop([self.mirror.url, self.pypi.url])
+
+    def test_preferred_server_is_used_first(self):
+        self.client.get_package_versions('a')
+        self.mirror.stop()
+        self.assertEqual(len(self.mirror.calls), 1)
+        self.assertEqual(self.pypi.calls, [])
+
+    def test_failover(self):
+        self.mirror.stop()
+        self.assertEqual(self.client.get_package_versions('a'),
+                         ['a.0', 'a.1', 'a.2'])
+        self.assertEqual(self.client.get_multiple_package_versions(['b']),
+                         {'b': ['b.0', 'b.1', 'b.2']})
+        self.assertEqual(len(self.pypi.calls), 2)
+        stats = dict((s['url'], s) for s in get_all_server_stats())
+        self.assertEqual(stats[self.mirror.url]['failures'], 1)
+        self.assertFalse(stats[self.mirror.url]['healthy'])
+        self.assertEqual(stats[self.pypi.url]['requests'], 2)
+        self.assertTrue(stats[self.pypi.url]['healthy'])
+
+    def test_every_server_has_its_own_breaker(self):
+        self.assertIs(get_breaker(self.pypi.url), get_breaker(self.pypi.url))
+        self.mirror.stop()
+        client = get_pypi_client([self.mirror.url, self.pypi.url])
+        client.get_package_versions('a')
+        # The failing mirror does not slow down requests to PyPi
+        mirror = ServiceState.objects.get(name='pypi %s' % self.mirror.url)
+        pypi = ServiceState.objects.get(name='pypi %s' % self.pypi.url)
+        self.assertEqual(mirror.failures, 1)
+        self.assertEqual(pypi.failures, 0)
+        self.assertEqual(pypi.rate, 10)
+
+    @override_settings(FOLIVORA_PYPI_STATS_INTERVAL=0)
+    def test_stats_are_stored(self):
+        self.mirror.stop()
+        client = get_pypi_client([self.mirror.url, self.pypi.url])
+        client.get_package_versions('a')
+        client.get_package_versions('b')
+        mirror = ServiceState.objects.get(name='pypi %s' % self.mirror.url)
+        pypi = ServiceState.objects.get(name='pypi %s' % self.pypi.url)
+        self.assertEqual((mirror.requests, mirror.errors), (1, 1))
+        self.assertEqual((pypi.requests, pypi.errors), (2, 0))
+        self.assertIsNotNone(pypi.latency)
+        self.assertEqual(pypi.error_rate, 0)
+
+    def test_stats_are_reported_periodically(self):
+        stats = get_server_stats(self.pypi.url)
+        stats.success(0.1)
+        self.assertEqual(stats.unreported(60), (1, 0))
+        stats.success(0.1)
+        self.assertIsNone(stats.unreported(60))
+        self.assertEqual(stats.unreported(0), (1, 0))
+        self.mirror.stop()
+
+    def test_open_breaker_is_skipped(self):
+        breakers = {self.mirror.url: mock.Mock(), self.pypi.url: mock.Mock()}
+        breakers[self.mirror.url].acquire.side_effect = CircuitOpen(60)
+        client = CheeseShop([self.mirror.url, self.pypi.url],
+                            get_guard=breakers.get)
+        self.assertEqual(client.get_package_versions('a'),
+                         ['a.0', 'a.1', 'a.2'])
+        self.assertEqual(self.mirror.calls, [])
+        self.assertEqual(len(self.pypi.calls), 1)
+        stats = get_server_stats(self.mirror.url)
+        self.assertEqual(stats.failures, 0)
+        self.assertFalse(stats.healthy)
+        # The mirror stays out of rotation while its circuit is open
+        self.assertEqual(client.xmlrpc.ordered_servers()[0][0].url,
+                         self.pypi.url)
+        self.mirror.stop()
+
+    def test_unavailable_if_every_breaker_refuses(self):
+        breaker = mock.Mock()
+        breaker.acquire.side_effect = CircuitOpen(60)
+        client = CheeseShop([self.mirror.url, self.pypi.url],
+                            get_guard=lambda url: breaker)
+        self.assertRaises(CircuitOpen, client.get_package_versions, 'a')
+        self.assertEqual(self.mirror.calls + self.pypi.calls, [])
+        self.mirror.stop()
+
+    def test_fastest_server_is_used(self):
+        get_server_stats(self.mirror.url).latency = 1.0
+        get_server_stats(self.pypi.url).latency = 0.01
+        self.client.get_package_versions('a')
+        self.mirror.stop()
+        self.assertEqual(self.mirror.calls, [])
+        self.assertEqual(len(self.pypi.calls), 1)
+
+
+class TestFilesystemMirror(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'json'))
+        self.write('PmxBot', {
+            'info': {'version': '1101.8.2'},
+            'releases': {
+                '1101.8.1': [{'upload_time': '2012-08-18T03:17:15'}],
+                '1101.8.2': [{'upload_time': '2012-08-19T03:17:15'}],
+                '1101.8.0': []}})
+
+    def write(self, name, document):
+        with open(os.path.join(self.root, 'json', name), 'w') as f:
+            json.dump(document, f)
+
+    def test_read_package(self):
+        mirror = FilesystemMirror(self.root)
+        self.assertEqual(sorted(mirror.get_package_versions('pmxbot')),
+                         ['1101.8.0', '1101.8.1', '1101.8.2'])
+        urls = mirror.get_multiple_release_urls('pmxbot', ['1101.8.1'])
+        self.assertEqual(urls['1101.8.1'][0]['upload_time'],
+                         datetime(2012, 8, 18, 3, 17, 15))
+        self.assertEqual(mirror.get_release_data('pmxbot'),
+                         {'version': '1101.8.2'})
+        self.assertEqual(mirror.get_package_versions('gunicorn'), [])
+
+    def test_index_follows_directory(self):
+        mirror = FilesystemMirror(self.root)
+        self.assertEqual(mirror.get_package_list(), ['PmxBot'])
+        self.write('gunicorn', {'info': {}, 'releases': {'0.14.6': []}})
+        self.assertEqual(mirror.get_package_list(), ['PmxBot', 'gunicorn'])
+        self.assertEqual(mirror.get_package_versions('gunicorn'), ['0.14.6'])
+
+    def test_sync_versions_of_mirror_package(self):
+        pkg = Package.create_with_provider_url('pmxbot',
+                                               provider=Package.MIRROR)
+        with override_settings(FOLIVORA_MIRROR_ROOT=self.root):
+            with mock.patch('folivora.models.get_pypi_client',
+                            NotConnectedCheesyMock):
+                pkg.sync_versions()
+        self.assertEqual(pkg.versions.count(), 2)
+        self.assertEqual(pkg.latest_version.version, '1101.8.2')
+
+
+class TestConcurrentCheeseShop(TestCase):
+
+    def setUp(self):
+        self.server = XMLRPCTestServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        # The guard would use a database connection per thread.
+        self.client = ConcurrentCheeseShop(self.server.url, concurrency=4,
+                                           get_guard=mock.Mock())
+        self.addCleanup(self.client.close)
+
+    def test_calls_return_async_results(self):
+        results = [self.client.get_package_versions(name)
+                   for name in ('a', 'b', 'c')]
+        self.assertEqual([r.get() for r in results],
+                         [['a.0', 'a.1', 'a.2'], ['b.0', 'b.1', 'b.2'],
+                          ['c.0', 'c.1', 'c.2']])
+
+    def test_backfill_versions(self):
+        Package.create_with_provider_url('pmxbot')
+        Package.create_with_provider_url('gunicorn')
+        synced = tasks.backfill_versions(self.client, Package.objects.all())
+        self.assertEqual(synced, 2)
+        self.assertEqual(PackageVersion.objects.count(), 6)
+        self.assertFalse(Package.objects.filter(
+            initial_sync_done=False).exists())
+        pmxbot = Package.objects.get(name='pmxbot')
+        self.assertEqual(pmxbot.latest_version.version, 'pmxbot.2')
+        # One multicall for the versions, one per package for the urls.
+        self.assertEqual(self.server.server.requests, 3)
+
+    def test_backfill_versions_skips_failing_packages(self):
+        Package.create_with_provider_url('pmxbot')
+        Package.create_with_provider_url('broken')
+        package_releases = self.server.package_releases
+
+        def failing_package_releases(name):
+            if name == 'broken':
+                raise xmlrpclib.Fault(1, 'no such package')
+            return package_releases(name)
+        self.server.server.funcs['package_releases'] = \
+            failing_package_releases
+        synced = tasks.backfill_versions(self.client, Package.objects.all())
+        self.assertEqual(synced, 1)
+        self.assertEqual(list(Package.objects.filter(initial_sync_done=True)
+                                             .values_list('name', flat=True)),
+                         ['pmxbot'])
+
+
+class TestLoadCatalog(TestCase):
+
+    def test_load_package_names(self):
+        names = ['pmxbot', 'Foo_Bar', u'caf\xe9', 'back\\slash']
+        self.assertEqual(load_package_names(names, chunk_size=3), 4)
+        for package in Package.objects.all():
+            self.assertEqual(package.normalized_name,
+                             normalize_name(package.name))
+        self.assertEqual(Package.objects.get(name='back\\slash').url,
+                         'http://pypi.python.org/pypi/back\\slash')
+
+    def test_only_new_names_are_loaded(self):
+        Package.create_with_provider_url('pmxbot')
+        self.assertEqual(load_package_names(['pmxbot', 'foo-bar',
+                                             'Foo_Bar']), 1)
+        self.assertEqual(Package.objects.count(), 2)
+
+    @mock.patch('folivora.management.commands.load_catalog.get_pypi_client',
+                mock.Mock(return_value=CheesyMock()))
+    def test_command(self):
+        call_command('load_catalog', interactive=False)
+        self.assertEqual(sorted(Package.objects.values_list('name',
+                                                            flat=True)),
+                         ['gunicorn', 'pmxbot'])
+        state = SyncState.objects.get(type=SyncState.CHANGELOG)
+        self.assertEqual(state.last_serial, 42)
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        self.package = Package.create_with_provider_url(u'caf\xe9')
+        self.package.initial_sync_done = True
+        self.package.save()
+        Package.create_with_provider_url('pmxbot')
+        PackageVersion.objects.create(
+            package=self.package, version='1.0',
+            release_date=datetime(2012, 8, 18, 3, 17, 15, 42, tzinfo=pytz.UTC))
+        PackageVersion.objects.create(
+            package=self.package, version='1.10',
+            release_date=datetime(1969, 12, 31, tzinfo=pytz.UTC))
+        SyncState.objects.create(type=SyncState.CHANGELOG, last_serial=42)
+
+    def export(self):
+        out = StringIO()
+        self.assertEqual(export_catalog(out), (2, 2))
+        return StringIO(out.getvalue())
+
+    def test_columns(self):
+        header, columns = read_snapshot(self.export())
+        self.assertEqual(header['serial'], 42)
+        self.assertEqual(columns['package.name'], [u'caf\xe9', u'pmxbot'])
+        self.assertEqual(list(columns['package.initial_sync_done']), [1, 0])
+        self.assertEqual(columns['version.dictionary'], [u'1.0', u'1.10'])
+        self.assertEqual(list(columns['version.package']), [0, 0])
+        self.assertEqual(columns['version.release_date'],
+                         [1345259835000042, -86400000000])
+
+    def test_write_and_read(self):
+        out = StringIO()
+        write_snapshot(out, {'serial': None}, [
+            ('names', 'str', [u'', u'caf\xe9']),
+            ('codes', 'uint32', [0, 2 ** 32 - 1]),
+            ('dates', 'int64', [-1, 2 ** 62])])
+        header, columns = read_snapshot(StringIO(out.getvalue()))
+        self.assertEqual(header['columns'], [['names', 'str'],
+                                             ['codes', 'uint32'],
+                                             ['dates', 'int64']])
+        self.assertEqual(columns['names'], [u'', u'caf\xe9'])
+        self.assertEqual(list(columns['codes']), [0, 2 ** 32 - 1])
+        self.assertEqual(columns['dates'], [-1, 2 ** 62])
+
+    def test_invalid_snapshot(self):
+        out = StringIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write('not a snapshot')
+        self.assertRaises(ValueError, read_snapshot,
+                          StringIO(out.getvalue()))
+
+    def test_import(self):
+        snapshot = self.export()
+        Package.objects.all().delete()
+        SyncState.objects.all().delete()
+        self.assertEqual(import_catalog(snapshot, chunk_size=1), (2, 2))
+        package = Package.objects.get(name=u'caf\xe9')
+        self.assertTrue(package.initial_sync_done)
+        self.assertEqual(package.latest_version.version, '1.10')
+        self.assertEqual(package.latest_version.sort_key,
+                         version_sort_key('1.10'))
+        self.assertEqual(package.versions.get(version='1.0').release_date,
+                         datetime(2012, 8, 18, 3, 17, 15, 42,
+                                  tzinfo=pytz.UTC))
+        self.assertFalse(Package.objects.get(name='pmxbot').initial_sync_done)
+        self.assertEqual(SyncState.objects.get().last_serial, 42)
+
+    def test_import_keeps_existing_rows(self):
+        snapshot = self.export()
+        PackageVersion.objects.filter(version='1.10').delete()
+        SyncState.objects.update(last_serial=50)
+        self.assertEqual(import_catalog(snapshot), (0, 1))
+        self.assertEqual(self.package.versions.count(), 2)
+        self.assertEqual(SyncState.objects.get().last_serial, 50)
+
+    def test_commands(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'catalog.snapshot')
+            call_command('export_snapshot', path)
+            Package.objects.all().delete()
+            call_command('import_snapshot', path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(PackageVersion.objects.count(), 2)
+
+
+class TestChangelogCompaction(TestCase):
+
+    def test_irrelevant_actions_are_dropped(self):
+        changes = compact_changelog([
+            ['pmxbot', '0.1', 1345259834, 'add source file'],
+            ['pmxbot', '0.1', 1345259834, 'docupdate']])
+        self.assertEqual(changes, {})
+
+    def test_releases_are_folded(self):
+        changes = compact_changelog([
+            ['pmxbot', None, 1345259833, 'create'],
+            ['pmxbot', '0.1', 1345259834, 'new release'],
+            ['pmxbot', '0.1', 1345259834, 'add source file'],
+            ['pmxbot', '0.2', 1345259835, 'new release'],
+            ['pmxbot', '0.1', 1345259836, 'new release']])
+        pkg = changes['pmxbot']
+        self.assertTrue(pkg.created)
+        self.assertFalse(pkg.removes)
+        self.assertEqual(pkg.new_versions(set(['0.2'])),
+                         [('0.1', 1345259834)])
+
+    def test_remove_wipes_earlier_releases(self):
+        changes = compact_changelog([
+            ['pmxbot', '0.1', 1345259834, 'new release'],
+            ['pmxbot', None, 1345259835, 'remove'],
+            ['pmxbot', '0.2', 1345259836, 'new release']])
+        pkg = changes['pmxbot']
+        self.assertTrue(pkg.wiped)
+        self.assertEqual(pkg.removes, 1)
+        self.assertEqual(pkg.new_versions(set(['0.2'])),
+                         [('0.2', 1345259836)])
+
+    def test_remove_keeps_versions(self):
+        changes = compact_changelog([
+            ['pmxbot', '0.2', 1345259834, 'new release'],
+            ['pmxbot', '0.1', 1345259835, 'remove']])
+        pkg = changes['pmxbot']
+        self.assertFalse(pkg.wiped)
+        self.assertEqual(pkg.removes, 1)
+        self.assertEqual(pkg.new_versions(set()), [('0.2', 1345259834)])
+
+
 class TestSyncProjectTask(TestCase):
 
     def setUp(self):
@@ -330,7 +1459,7 @@ class TestSyncProjectTask(TestCase):
             package=pkg3,
             version='2012a')
 
-    @mock.patch('folivora.models.CheeseShop', CheesyMock)
+    @mock.patch('folivora.models.get_pypi_client', CheesyMock)
     def test_sync_project(self):
         result = tasks.sync_project.apply(args=(self.project.pk,), throw=True)
         self.assertTrue(result.successful())
@@ -344,8 +1473,55 @@ class TestSyncProjectTask(TestCase):
                                             package__name='gunicorn')
         self.assertEqual(dep.update, None)
 
+    @mock.patch('folivora.models.get_pypi_client', CheesyMock)
+    def test_update_dependencies_of_many_projects(self):
+        tasks.update_dependencies([self.project.pk])
+        pmxbot = Package.objects.get(name='pmxbot')
+        pytz = Package.objects.get(name='pytz')
+        projects = []
+        for idx in range(5):
+            project = Project.objects.create(name='p%d' % idx,
+                                             slug='p%d' % idx)
+            ProjectDependency.objects.create(project=project, package=pmxbot,
+                                             version='1101.8.0')
+            ProjectDependency.objects.create(project=project, package=pytz,
+                                             version='2012d')
+            projects.append(project.pk)
+        projects.append(self.project.pk)
+        with self.assertNumQueries(5):
+            log_entries = tasks.update_dependencies(projects)
+        self.assertEqual(sorted(log_entries), sorted(projects[:-1]))
+        self.assertEqual(Log.objects.filter(action='update_available',
+                                            project__in=projects).count(), 7)
+        self.assertEqual(ProjectDependency.objects.filter(
+            package=pmxbot, update=pmxbot.latest_version).count(), 6)
+        self.assertEqual(ProjectDependency.objects.filter(
+            package=pytz, update__isnull=False).count(), 1)
+
+    @override_settings(FOLIVORA_PARTIAL_SYNC=True)
+    @mock.patch('folivora.models.get_pypi_client', CheesyMock)
+    def test_update_dependencies_with_partial_sync(self):
+        tasks.update_dependencies([self.project.pk])
+        pmxbot = Package.objects.get(name='pmxbot')
+        self.assertEqual(pmxbot.synced_from, '1101.8.0')
+        pytz = Package.objects.get(name='pytz')
+        projects = []
+        for idx in range(5):
+            project = Project.objects.create(name='p%d' % idx,
+                                             slug='p%d' % idx)
+            ProjectDependency.objects.create(project=project, package=pmxbot,
+                                             version='1101.8.0')
+            ProjectDependency.objects.create(project=project, package=pytz,
+                                             version='2012d')
+            projects.append(project.pk)
+        projects.append(self.project.pk)
+        # Only one more query, for the lowest pins of all packages
+        with self.assertNumQueries(6):
+            log_entries = tasks.update_dependencies(projects)
+        self.assertEqual(sorted(log_entries), sorted(projects[:-1]))
+
     @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
-    @mock.patch('folivora.models.CheeseShop', CheesyMock)
+    @mock.patch('folivora.models.get_pypi_client', CheesyMock)
     def test_sync_project_sends_mail(self):
         ProjectMember.objects.create(user=self.user, project=self.project,
                                      state=ProjectMember.MEMBER)
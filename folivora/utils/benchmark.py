@@ -0,0 +1,202 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Helpers for the benchmark management commands.
+"""
+import time
+import random
+import resource
+import datetime
+from contextlib import contextmanager
+
+import pytz
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+from django.db.backends.util import CursorDebugWrapper
+
+from ..models import (Package, PackageVersion, Project, ProjectMember,
+    ProjectDependency)
+
+
+CHUNK_SIZE = 1000
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    """Run the block against a freshly migrated, temporary database.
+
+    The database is created like the one of the test runner and dropped
+    afterwards, so benchmarks never touch real data.
+    """
+    from south.management.commands import patch_for_test_db_setup
+    patch_for_test_db_setup()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity)
+
+
+@contextmanager
+def local_tasks():
+    """Run Celery tasks queued in the block in this process and keep
+    sent mails in memory.
+    """
+    values = {
+        'CELERY_ALWAYS_EAGER': True,
+        'EMAIL_BACKEND': 'django.core.mail.backends.locmem.EmailBackend',
+    }
+    missing = object()
+    previous = dict((name, getattr(settings, name, missing))
+                    for name in values)
+    for name, value in values.iteritems():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.iteritems():
+            if value is missing:
+                delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+
+
+class SyntheticCheeseShop(object):
+    """Stand-in for :class:`CheeseShop` releasing version ``2.0`` of the
+    first `releases` synthetic packages created by :func:`populate`.
+    """
+
+    def __init__(self, releases=100):
+        self.releases = releases
+
+    def get_last_serial(self):
+        return self.releases
+
+    def get_changelog_since_serial(self, serial):
+        return [['package-%d' % i, '2.0', 1345259834, 'new release', i + 1]
+                for i in xrange(serial, self.releases)]
+
+    def get_package_versions(self, name):
+        return ['2.0']
+
+    def get_multiple_release_urls(self, name, versions):
+        upload_time = datetime.datetime(2012, 8, 18, 3, 17, 15)
+        return dict((v, [{'upload_time': upload_time}]) for v in versions)
+
+
+def _chunks(items):
+    for offset in xrange(0, len(items), CHUNK_SIZE):
+        yield items[offset:offset + CHUNK_SIZE]
+
+
+def populate(packages=1000, versions=10, projects=100, dependencies=20,
+             names=(), seed=0):
+    """Fill the database with synthetic packages and projects.
+
+    :param packages: Number of packages, including `names`.
+    :param versions: Number of versions per synthetic package.
+    :param projects: Number of projects, all owned by one user.
+    :param dependencies: Number of dependencies per project, all pinned to
+                         the first version so that updates are available.
+    :param names: Additional package names without versions, their
+                  initial sync has to fetch them (e.g. from a fixture).
+    :param seed: Seed for the choice of dependencies.
+    """
+    rnd = random.Random(seed)
+    names = list(names)
+    synthetic = ['package-%d' % i
+                 for i in xrange(max(packages - len(names), 0))]
+    for chunk in _chunks(names):
+        Package.objects.bulk_create([Package.from_name(n) for n in chunk])
+    for chunk in _chunks(synthetic):
+        objs = [Package.from_name(n) for n in chunk]
+        for obj in objs:
+            obj.initial_sync_done = True
+        Package.objects.bulk_create(objs)
+
+    release_date = datetime.datetime(2012, 1, 1, tzinfo=pytz.UTC)
+    package_ids = list(Package.objects.values_list('id', flat=True))
+    synthetic_ids = Package.objects.filter(initial_sync_done=True) \
+                                   .values_list('id', flat=True)
+    for chunk in _chunks(list(synthetic_ids)):
+        PackageVersion.bulk_insert([
+            PackageVersion(package_id=pk, version='1.%d' % i,
+                           release_date=release_date)
+            for pk in chunk
+            for i in xrange(versions)])
+
+    user, created = User.objects.get_or_create(
+        username='benchmark', defaults={'email': 'benchmark@example.com'})
+    for chunk in _chunks(range(projects)):
+        Project.objects.bulk_create([Project(name='Project %d' % i,
+                                             slug='project-%d' % i)
+                                     for i in chunk])
+    project_ids = list(Project.objects.values_list('id', flat=True))
+    for chunk in _chunks(project_ids):
+        ProjectMember.objects.bulk_create([
+            ProjectMember(project_id=pk, user=user,
+                          state=ProjectMember.OWNER, mail=user.email)
+            for pk in chunk])
+        ProjectDependency.objects.bulk_create([
+            ProjectDependency(project_id=pk, package_id=package, version='1.0')
+            for pk in chunk
+            for package in rnd.sample(package_ids,
+                                      min(dependencies, len(package_ids)))])
+
+
+class RowCountingCursor(CursorDebugWrapper):
+    """Debug cursor adding up the rows returned or changed by each query."""
+
+    def __init__(self, cursor, db, counter):
+        super(RowCountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        try:
+            return super(RowCountingCursor, self).execute(sql, params)
+        finally:
+            self.counter[0] += max(self.cursor.rowcount, 0)
+
+    def executemany(self, sql, param_list):
+        try:
+            return super(RowCountingCursor, self).executemany(sql, param_list)
+        finally:
+            self.counter[0] += max(self.cursor.rowcount, 0)
+
+
+def measure(func, *args, **kwargs):
+    """Call `func` and return ``(result, stats)``.
+
+    `stats` contains the wall clock ``time`` in seconds, the number of
+    database ``queries``, the number of ``rows`` they returned or changed
+    and ``peak_memory_increase``, the KiB the call raised the peak memory
+    usage of the process by.  The latter is a lower bound: it is 0 if the
+    call stayed below the peak of earlier steps, e.g. :func:`populate`.
+    """
+    rows = [0]
+    connection.use_debug_cursor = True
+    connection.make_debug_cursor = \
+        lambda cursor: RowCountingCursor(cursor, connection, rows)
+    reset_queries()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+        elapsed = time.time() - start
+        queries = len(connection.queries)
+    finally:
+        del connection.make_debug_cursor
+        connection.use_debug_cursor = None
+        reset_queries()
+    stats = {
+        'time': elapsed,
+        'queries': queries,
+        'rows': rows[0],
+        'peak_memory_increase':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak,
+    }
+    return result, stats
@@ -0,0 +1,50 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.bulk
+    ~~~~~~~~~~~~~~~~~~~
+
+    Helpers to load large amounts of rows with postgres COPY.
+"""
+from cStringIO import StringIO
+
+
+def normalized_name_sql(column):
+    """SQL expression computing :func:`normalize_name` of `column`."""
+    return "lower(regexp_replace(%s, '[^A-Za-z0-9.]+', '-', 'g'))" % column
+
+
+def copy_escape(value):
+    """Escape `value` for the text format of COPY."""
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+                .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return copy_escape(value)
+
+
+def copy_rows(cursor, table, columns, rows, chunk_size=10000):
+    """Send `rows` to `table` with COPY, `chunk_size` rows at a time.
+
+    :param rows: Iterable of tuples of strings, numbers, booleans or
+                 `None`, in the order of `columns`.
+    """
+    def flush(lines):
+        cursor.copy_from(StringIO(''.join(lines)), table, columns=columns)
+
+    lines = []
+    for row in rows:
+        lines.append('\t'.join(_copy_value(v) for v in row) + '\n')
+        if len(lines) >= chunk_size:
+            flush(lines)
+            lines = []
+    if lines:
+        flush(lines)
@@ -0,0 +1,161 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.cache
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Cache for PyPi responses that rarely change, backed by Django's cache
+    framework.  Caching is enabled by pointing ``FOLIVORA_PYPI_CACHE`` to
+    an alias in ``CACHES``, the size of the cache is bounded by that
+    backend (e.g. ``MAX_ENTRIES``).
+"""
+import uuid
+import hashlib
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+#: Seconds responses are cached, override with
+#: ``FOLIVORA_PYPI_CACHE_TIMEOUTS``.
+DEFAULT_TIMEOUTS = {
+    'package_releases': 60 * 60,
+    'release_urls': 24 * 60 * 60,
+    'release_data': 60 * 60,
+}
+
+
+def get_pypi_cache():
+    """Return the configured cache or `None` if caching is disabled."""
+    alias = getattr(settings, 'FOLIVORA_PYPI_CACHE', None)
+    return get_cache(alias) if alias else None
+
+
+def get_timeouts():
+    timeouts = DEFAULT_TIMEOUTS.copy()
+    timeouts.update(getattr(settings, 'FOLIVORA_PYPI_CACHE_TIMEOUTS', {}))
+    return timeouts
+
+
+def _key(*parts):
+    # Package names may contain characters memcached does not accept.
+    raw = '\0'.join(unicode(p).encode('utf-8') for p in parts)
+    return 'folivora.pypi.%s' % hashlib.md5(raw).hexdigest()
+
+
+def _generation_keys(names):
+    return dict((_key('generation', name), name) for name in names)
+
+
+def invalidate_packages(names):
+    """Drop the cached responses of all packages in `names`.
+
+    Responses are stored under a per package generation, a new generation
+    makes all older entries unreachable until they expire.
+    """
+    cache = get_pypi_cache()
+    names = set(names)
+    if cache is None or not names:
+        return
+    cache.set_many(dict((key, uuid.uuid4().hex)
+                        for key in _generation_keys(names)),
+                   max(get_timeouts().values()))
+
+
+def cached_client(client):
+    """Wrap `client` in a :class:`CachingCheeseShop` if caching is enabled."""
+    cache = get_pypi_cache()
+    if cache is None:
+        return client
+    return CachingCheeseShop(client, cache, get_timeouts())
+
+
+class CachingCheeseShop(object):
+    """Caches `package_releases`, `release_urls` and `release_data`
+    responses of a :class:`CheeseShop`, everything else is passed through.
+
+    :param client: The wrapped :class:`CheeseShop`.
+    :param cache: A Django cache backend.
+    :param timeouts: Seconds to cache responses, by XML-RPC method.
+    """
+
+    def __init__(self, client, cache, timeouts=DEFAULT_TIMEOUTS):
+        self.client = client
+        self.cache = cache
+        self.timeouts = timeouts
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _generations(self, names):
+        keys = _generation_keys(names)
+        generations = self.cache.get_many(keys.keys())
+        missing = dict((key, uuid.uuid4().hex) for key in keys
+                       if key not in generations)
+        if missing:
+            self.cache.set_many(missing, max(self.timeouts.values()))
+            generations.update(missing)
+        return dict((keys[key], gen) for key, gen in generations.iteritems())
+
+    def _cached(self, method, name, args, fetch):
+        """Look up ``method(name, *args)`` for all `args`, call
+        `fetch` with the missing ones and return a dictionary by args.
+        """
+        generation = self._generations([name])[name]
+        keys = dict((_key(method, generation, name, *a), a) for a in args)
+        found = self.cache.get_many(keys.keys())
+        results = dict((keys[key], value) for key, value in found.iteritems())
+        missing = [a for a in args if a not in results]
+        if missing:
+            fetched = fetch(missing)
+            self.cache.set_many(
+                dict((_key(method, generation, name, *a), fetched[a])
+                     for a in missing),
+                self.timeouts[method])
+            results.update(fetched)
+        return results
+
+    def get_package_versions(self, package_name):
+        return self._cached(
+            'package_releases', package_name, [()],
+            lambda missing: {(): self.client.get_package_versions(
+                package_name)})[()]
+
+    def get_multiple_package_versions(self, package_names):
+        package_names = list(package_names)
+        generations = self._generations(package_names)
+        keys = dict((_key('package_releases', generations[name], name), name)
+                    for name in package_names)
+        found = self.cache.get_many(keys.keys())
+        results = dict((keys[key], value) for key, value in found.iteritems())
+        missing = [name for name in package_names if name not in results]
+        if missing:
+            fetched = self.client.get_multiple_package_versions(missing)
+            self.cache.set_many(
+                dict((_key('package_releases', generations[name], name),
+                      fetched[name]) for name in missing),
+                self.timeouts['package_releases'])
+            results.update(fetched)
+        return results
+
+    def get_release_urls(self, package_name, version):
+        return self.get_multiple_release_urls(package_name, [version])[version]
+
+    def get_multiple_release_urls(self, package_name, versions):
+        def fetch(missing):
+            urls = self.client.get_multiple_release_urls(
+                package_name, [v for v, in missing])
+            return dict(((v,), value) for v, value in urls.iteritems())
+        results = self._cached('release_urls', package_name,
+                               [(v,) for v in versions], fetch)
+        return dict((v, value) for (v,), value in results.iteritems())
+
+    def get_release_data(self, package_name, version=None):
+        if version is None:
+            versions = self.get_package_versions(package_name)
+            if not versions:
+                return {}
+            version = versions[-1]
+        return self._cached(
+            'release_data', package_name, [(version,)],
+            lambda missing: {(version,): self.client.get_release_data(
+                package_name, version)})[(version,)]
@@ -0,0 +1,83 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.changelog
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Utilities to compact the PyPi changelog before it is applied.
+"""
+from collections import OrderedDict
+
+
+class PackageChanges(object):
+    """The net effect of all changelog events for one package.
+
+    :attr created: A `create` or `new release` was seen, the package has
+                   to exist after the window was applied.
+    :attr removes: Number of `remove` events, each one creates a log entry.
+    :attr wiped: A `remove` without version was seen, all versions stored
+                 before that event have to be deleted.
+    :attr releases: Released versions since the last wipe, mapped to the
+                    timestamp of their first occurrence.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.created = False
+        self.removes = 0
+        self.wiped = False
+        self.releases = OrderedDict()
+
+    @property
+    def released(self):
+        return bool(self.releases)
+
+    def add_release(self, version, stamp):
+        self.created = True
+        if version not in self.releases:
+            self.releases[version] = stamp
+
+    def add_remove(self, version):
+        self.removes += 1
+        if version is None:
+            self.wiped = True
+            self.releases.clear()
+
+    def new_versions(self, existing):
+        """Return ``(version, stamp)`` pairs that have to be inserted.
+
+        :param existing: Versions stored before the window was applied.
+        """
+        if self.wiped:
+            existing = ()
+        return [(version, stamp) for version, stamp
+                in self.releases.iteritems() if version not in existing]
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.name)
+
+
+def compact_changelog(log):
+    """Fold changelog events into one :class:`PackageChanges` per package.
+
+    Only `new release`, `remove` and `create` are relevant, everything
+    else (`add ... file`, `docupdate` ...) is dropped.  Packages are
+    returned in the order of their first relevant event.
+
+    :param log: Iterable of ``(name, version, stamp, action)`` tuples,
+                additional items like the event serial are ignored.
+    """
+    changes = OrderedDict()
+    for event in log:
+        name, version, stamp, action = event[:4]
+        if action not in ('new release', 'remove', 'create'):
+            continue
+        if name not in changes:
+            changes[name] = PackageChanges(name)
+        package = changes[name]
+        if action == 'new release':
+            package.add_release(version, stamp)
+        elif action == 'remove':
+            package.add_remove(version)
+        else:
+            package.created = True
+    return changes
@@ -0,0 +1,144 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.circuit
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Circuit breaker and rate limiter for PyPi requests.  The state lives
+    in the database (:class:`folivora.models.ServiceState`), so all
+    workers back off together.
+"""
+import time
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+
+
+class Unavailable(Exception):
+    """The service must not be called right now.
+
+    :attr retry_after: Seconds until a call is expected to be allowed.
+    """
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, retry_after)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(Unavailable):
+    """Too many requests failed in a row."""
+
+
+class RateLimited(Unavailable):
+    """No request token becomes available within the allowed wait."""
+
+
+class CircuitBreaker(object):
+    """Guards requests to the service `name`.
+
+    A token bucket allows ``FOLIVORA_PYPI_RATE`` requests per second with
+    bursts of ``FOLIVORA_PYPI_BURST``.  The rate is halved on every failure
+    and recovers slowly on success.  After ``FOLIVORA_PYPI_FAILURE_THRESHOLD``
+    failures in a row the circuit opens for ``FOLIVORA_PYPI_RESET_TIMEOUT``
+    seconds, then a single request probes whether the service is back.
+
+    Used by :class:`folivora.utils.pypi.KeepAliveTransport` as its guard.
+    """
+    table = 'folivora_servicestate'
+
+    def __init__(self, name):
+        self.name = name
+        # Last known state, per thread since the breaker is shared.
+        self._local = threading.local()
+
+    @property
+    def max_rate(self):
+        return float(getattr(settings, 'FOLIVORA_PYPI_RATE', 10))
+
+    def _execute(self, sql, params):
+        cursor = connection.cursor()
+        cursor.execute(sql % {'table': self.table}, params)
+        row = cursor.fetchone() if cursor.description else None
+        transaction.commit_unless_managed()
+        return row
+
+    def acquire(self):
+        """Take a request token, waiting for one if necessary.
+
+        Raises :exc:`CircuitOpen` or :exc:`RateLimited` instead of waiting
+        longer than ``FOLIVORA_PYPI_MAX_WAIT`` seconds.
+        """
+        burst = getattr(settings, 'FOLIVORA_PYPI_BURST', 20)
+        threshold = getattr(settings, 'FOLIVORA_PYPI_FAILURE_THRESHOLD', 5)
+        reset = getattr(settings, 'FOLIVORA_PYPI_RESET_TIMEOUT', 60)
+        max_wait = getattr(settings, 'FOLIVORA_PYPI_MAX_WAIT', 10)
+        deadline = time.time() + max_wait
+        while True:
+            now = time.time()
+            # Takes a token if the circuit is closed (or may be probed) and
+            # one is available, a probe keeps the circuit open for others.
+            row = self._execute(
+                'UPDATE %(table)s SET '
+                'tokens = LEAST(%%s, tokens + (%%s - updated) * rate) - 1, '
+                'updated = %%s, opened_until = CASE WHEN failures >= %%s '
+                'THEN %%s ELSE opened_until END '
+                'WHERE name = %%s AND opened_until <= %%s '
+                'AND LEAST(%%s, tokens + (%%s - updated) * rate) >= 1 '
+                'RETURNING failures, rate',
+                [burst, now, now, threshold, now + reset, self.name, now,
+                 burst, now])
+            if row is not None:
+                self._local.failures, self._local.rate = row
+                return
+            row = self._execute(
+                'SELECT opened_until, tokens + (%%s - updated) * rate, rate '
+                'FROM %(table)s WHERE name = %%s', [now, self.name])
+            if row is None:
+                self._execute(
+                    'INSERT INTO %(table)s (name, failures, opened_until, '
+                    'tokens, rate, updated, requests, errors, error_rate) '
+                    'VALUES (%%s, 0, 0, %%s, %%s, %%s, 0, 0, 0) '
+                    'ON CONFLICT (name) DO NOTHING',
+                    [self.name, burst, self.max_rate, now])
+                continue
+            opened_until, tokens, rate = row
+            if opened_until > now:
+                raise CircuitOpen(opened_until - now)
+            wait = (1 - tokens) / rate
+            if now + wait > deadline:
+                raise RateLimited(wait)
+            time.sleep(wait)
+
+    def success(self):
+        """Close the circuit and let the rate recover."""
+        failures = getattr(self._local, 'failures', None)
+        rate = getattr(self._local, 'rate', None)
+        if failures == 0 and rate == self.max_rate:
+            return
+        self._execute(
+            'UPDATE %(table)s SET failures = 0, opened_until = 0, '
+            'rate = LEAST(%%s, rate + %%s) WHERE name = %%s',
+            [self.max_rate, self.max_rate / 10, self.name])
+        self._local.failures = self._local.rate = None
+
+    def failure(self):
+        """Count a failed request, opening the circuit if necessary."""
+        threshold = getattr(settings, 'FOLIVORA_PYPI_FAILURE_THRESHOLD', 5)
+        reset = getattr(settings, 'FOLIVORA_PYPI_RESET_TIMEOUT', 60)
+        self._execute(
+            'UPDATE %(table)s SET failures = failures + 1, '
+            'rate = GREATEST(%%s, rate / 2), opened_until = CASE '
+            'WHEN failures + 1 >= %%s THEN %%s ELSE opened_until END '
+            'WHERE name = %%s',
+            [self.max_rate / 100, threshold, time.time() + reset, self.name])
+        self._local.failures = self._local.rate = None
+
+    def record(self, requests, errors, latency, error_rate):
+        """Add `requests` and `errors` to the totals of the service and
+        store the current `latency` and `error_rate`, for monitoring.
+        """
+        self._execute(
+            'UPDATE %(table)s SET requests = requests + %%s, '
+            'errors = errors + %%s, latency = COALESCE(%%s, latency), '
+            'error_rate = %%s WHERE name = %%s',
+            [requests, errors, latency, error_rate, self.name])
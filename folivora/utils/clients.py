@@ -0,0 +1,96 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.clients
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Builds the PyPi clients used by folivora from the settings.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .circuit import CircuitBreaker
+from .pypi import (CheeseShop, DEFAULT_SERVER, DEFAULT_BATCH_SIZE,
+    DEFAULT_TIMEOUT)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_client = None
+
+
+def get_pypi_servers():
+    """Return the servers in ``FOLIVORA_PYPI_SERVERS``, PyPi by default."""
+    return getattr(settings, 'FOLIVORA_PYPI_SERVERS', [DEFAULT_SERVER])
+
+
+def get_batch_size():
+    """Return ``FOLIVORA_PYPI_BATCH_SIZE``, the calls per multicall."""
+    return getattr(settings, 'FOLIVORA_PYPI_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+def get_breaker(url):
+    """Return the process wide :class:`CircuitBreaker` of the server `url`.
+
+    Every server has its own, so failures of a mirror do not slow down
+    requests to the others.
+    """
+    with _breakers_lock:
+        if url not in _breakers:
+            _breakers[url] = CircuitBreaker('pypi %s' % url)
+        return _breakers[url]
+
+
+def report_server_stats(stats, interval=None):
+    """Add the :class:`~folivora.utils.pypi.ServerStats` of this process to
+    the :class:`~folivora.models.ServiceState` row of their server.
+
+    Every process reports a server at most every `interval` seconds,
+    ``FOLIVORA_PYPI_STATS_INTERVAL`` by default.  The stored latency and
+    error rate are those of the last reporting process.
+    """
+    if interval is None:
+        interval = getattr(settings, 'FOLIVORA_PYPI_STATS_INTERVAL', 60)
+    counts = stats.unreported(interval)
+    if counts is not None:
+        requests, errors = counts
+        get_breaker(stats.url).record(requests, errors, stats.latency,
+                                      stats.error_rate)
+
+
+def get_pypi_client(server=None, **kwargs):
+    """Return a :class:`CheeseShop` guarded by :func:`get_breaker`,
+    reporting with :func:`report_server_stats`.
+
+    Requests time out after ``FOLIVORA_PYPI_TIMEOUT`` seconds, multicalls
+    are sent in batches of ``FOLIVORA_PYPI_BATCH_SIZE`` calls.  Within
+    :func:`use_client` the client given there is returned instead.
+
+    :param server: URL or URLs of the XML-RPC endpoint, defaults to
+                   :func:`get_pypi_servers`.
+    :param kwargs: Passed on to :class:`CheeseShop`.
+    """
+    if _client is not None:
+        return _client
+    if server is None:
+        server = get_pypi_servers()
+    kwargs.setdefault('timeout', getattr(settings, 'FOLIVORA_PYPI_TIMEOUT',
+                                         DEFAULT_TIMEOUT))
+    kwargs.setdefault('batch_size', get_batch_size())
+    return CheeseShop(server, get_guard=get_breaker,
+                      report=report_server_stats, **kwargs)
+
+
+@contextmanager
+def use_client(client):
+    """Answer all PyPi requests of this process with `client` while the
+    block runs, e.g. a :class:`~folivora.utils.recording.ReplayCheeseShop`
+    for benchmarks.
+    """
+    global _client
+    previous, _client = _client, client
+    try:
+        yield client
+    finally:
+        _client = previous
@@ -0,0 +1,50 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.locks
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Locks shared between all workers, based on postgres advisory locks.
+"""
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+#: Namespaces of the advisory locks, the second key is the object id.
+PACKAGE_SYNC = 1
+JOURNAL_SHARD = 2
+CHANGELOG_FETCH = 3
+
+
+@contextmanager
+def advisory_lock(namespace, key):
+    """Hold the advisory lock `key` in `namespace` while the block runs.
+
+    Blocks until other workers holding the same lock released it.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_advisory_lock(%s, %s)', [namespace, key])
+    try:
+        yield
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [namespace, key])
+
+
+@contextmanager
+def try_advisory_lock(namespace, key):
+    """Like :func:`advisory_lock` but without waiting, the block gets
+    whether the lock was acquired::
+
+        with try_advisory_lock(JOURNAL_SHARD, shard) as acquired:
+            if not acquired:
+                return
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [namespace, key])
+    acquired, = cursor.fetchone()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)',
+                           [namespace, key])
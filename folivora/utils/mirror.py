@@ -0,0 +1,130 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.mirror
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Read package metadata from a PyPi mirror on disk, as written by
+    bandersnatch: one JSON document per package in ``<root>/json/``.
+"""
+import os
+import json
+import mmap
+import datetime
+import threading
+
+from .pypi import normalize_name
+
+
+UPLOAD_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(root):
+    """Return the process wide :class:`FilesystemMirror` of `root`."""
+    with _mirrors_lock:
+        if root not in _mirrors:
+            _mirrors[root] = FilesystemMirror(root)
+        return _mirrors[root]
+
+
+def read_file(path):
+    """Return the contents of `path`, read through :mod:`mmap`."""
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            # Empty files cannot be mapped.
+            return ''
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return mapped[:]
+        finally:
+            mapped.close()
+
+
+class FilesystemMirror(object):
+    """Answers the read calls of :class:`CheeseShop` from a local mirror.
+
+    The listing of the JSON directory is cached until the directory
+    changes, parsed documents until their file changes.
+
+    :param root: The mirror directory containing ``json/``.
+    :param max_documents: Number of parsed documents kept in memory.
+    """
+
+    def __init__(self, root, max_documents=128):
+        self.root = root
+        self.path = os.path.join(root, 'json')
+        self.max_documents = max_documents
+        self._lock = threading.Lock()
+        self._index = None
+        self._index_mtime = None
+        self._documents = {}
+
+    def get_index(self):
+        """Return a ``{normalized name: file name}`` mapping."""
+        mtime = os.stat(self.path).st_mtime
+        with self._lock:
+            if self._index is None or self._index_mtime != mtime:
+                self._index = dict((normalize_name(name), name)
+                                   for name in os.listdir(self.path))
+                self._index_mtime = mtime
+            return self._index
+
+    def get_document(self, package_name):
+        """Return the parsed JSON document of `package_name` or `None`."""
+        filename = self.get_index().get(normalize_name(package_name))
+        if filename is None:
+            return None
+        path = os.path.join(self.path, filename)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._documents.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        data = read_file(path)
+        document = json.loads(data) if data else {}
+        with self._lock:
+            if len(self._documents) >= self.max_documents:
+                self._documents.clear()
+            self._documents[path] = (mtime, document)
+        return document
+
+    def get_package_list(self):
+        return sorted(self.get_index().itervalues())
+
+    def get_package_versions(self, package_name):
+        document = self.get_document(package_name)
+        if not document:
+            return []
+        return document.get('releases', {}).keys()
+
+    def get_multiple_package_versions(self, package_names):
+        return dict((name, self.get_package_versions(name))
+                    for name in package_names)
+
+    def get_release_urls(self, package_name, version):
+        document = self.get_document(package_name) or {}
+        urls = []
+        for url in document.get('releases', {}).get(version, []):
+            url = dict(url)
+            if url.get('upload_time'):
+                url['upload_time'] = datetime.datetime.strptime(
+                    url['upload_time'][:19], UPLOAD_TIME_FORMAT)
+            urls.append(url)
+        return urls
+
+    def get_multiple_release_urls(self, package_name, versions):
+        return dict((version, self.get_release_urls(package_name, version))
+                    for version in versions)
+
+    def get_release_data(self, package_name, version=None):
+        document = self.get_document(package_name)
+        if not document:
+            return {}
+        if version is None or version == document['info'].get('version'):
+            return document['info']
+        return {}
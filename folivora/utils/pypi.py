@@ -5,9 +5,17 @@
 
     Utilities to access pypi compatible servers.
 """
+import os
 import time
-import pkg_resources
+import socket
+import httplib
+import threading
 import xmlrpclib
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+import pkg_resources
+
+from .circuit import Unavailable
 
 
 def normalize_name(name):
@@ -20,12 +28,353 @@ def get_seconds(hours):
 
 
 DEFAULT_SERVER = 'http://pypi.python.org/pypi/'
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_TIMEOUT = 30
+DEFAULT_CONCURRENCY = 20
+
+
+class ConnectionPool(object):
+    """Idle HTTP connections by ``(scheme, host)``.
+
+    Connections are never shared between processes, a pool inherited by
+    a forked worker starts out empty.
+
+    :param max_idle: Number of idle connections kept per host.
+    """
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._idle = defaultdict(list)
+
+    def get(self, key):
+        """Return an idle connection for `key` or `None`."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = defaultdict(list)
+            if self._idle[key]:
+                return self._idle[key].pop()
+
+    def put(self, key, connection):
+        """Return `connection` to the pool, closing it if the pool is full."""
+        with self._lock:
+            if (self._pid == os.getpid() and
+                    len(self._idle[key]) < self.max_idle):
+                self._idle[key].append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+
+#: Shared by all :class:`CheeseShop` instances of the process.
+connection_pool = ConnectionPool()
+
+
+class KeepAliveTransport(xmlrpclib.Transport):
+    """XML-RPC transport keeping HTTP/1.1 connections open in a pool.
+
+    Gzip encoded responses are accepted and decoded by
+    :class:`xmlrpclib.Transport`.
+
+    :param use_https: Connect with HTTPS instead of HTTP.
+    :param timeout: Socket timeout in seconds.
+    :param pool: The :class:`ConnectionPool`, the process wide one by
+                 default.
+    :param guard: Optional object with `acquire`, `success` and `failure`
+                  methods called around every request, e.g. a circuit
+                  breaker.  `acquire` may raise to refuse the request.
+    """
+
+    def __init__(self, use_https=False, timeout=DEFAULT_TIMEOUT, pool=None,
+                 guard=None):
+        xmlrpclib.Transport.__init__(self, use_datetime=0)
+        self.scheme = 'https' if use_https else 'http'
+        self.timeout = timeout
+        self.pool = connection_pool if pool is None else pool
+        self.guard = guard
+
+    def request(self, host, handler, request_body, verbose=0):
+        if self.guard is None:
+            return xmlrpclib.Transport.request(self, host, handler,
+                                               request_body, verbose)
+        self.guard.acquire()
+        try:
+            result = xmlrpclib.Transport.request(self, host, handler,
+                                                 request_body, verbose)
+        except xmlrpclib.Fault:
+            self.guard.success()
+            raise
+        except (socket.error, httplib.HTTPException, xmlrpclib.ProtocolError):
+            self.guard.failure()
+            raise
+        self.guard.success()
+        return result
+
+    def make_connection(self, host):
+        # The headers (e.g. authorization) are sent on pooled connections
+        # as well.
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        connection = self.pool.get((self.scheme, host))
+        if connection is None:
+            if self.scheme == 'https':
+                connection = httplib.HTTPSConnection(chost, None,
+                    timeout=self.timeout, **(x509 or {}))
+            else:
+                connection = httplib.HTTPConnection(chost,
+                                                    timeout=self.timeout)
+        self._connection = host, connection
+        return connection
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        try:
+            result = xmlrpclib.Transport.single_request(
+                self, host, handler, request_body, verbose)
+        except xmlrpclib.Fault:
+            # The response was read completely, the connection is fine.
+            self._release()
+            raise
+        except Exception:
+            self.close()
+            raise
+        self._release()
+        return result
+
+    def _release(self):
+        host, connection = self._connection
+        self._connection = None, None
+        if connection is not None:
+            self.pool.put((self.scheme, host), connection)
+
+
+class ServerStats(object):
+    """Request statistics of one server.
+
+    `latency` (seconds) and `error_rate` are exponentially weighted moving
+    averages.  A failed server is skipped until `retry_at`.
+    """
+    alpha = 0.2
+
+    def __init__(self, url):
+        self.url = url
+        self.requests = 0
+        self.failures = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.retry_at = 0
+        self._lock = threading.Lock()
+        self._reported = (0, 0, 0)
+
+    def success(self, latency):
+        with self._lock:
+            self.requests += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+            self.error_rate *= 1 - self.alpha
+
+    def failure(self, retry_after):
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+            self.error_rate += self.alpha * (1 - self.error_rate)
+            self.retry_at = time.time() + retry_after
+
+    def refused(self, retry_after):
+        # The guard refused the request, nothing was sent to the server.
+        with self._lock:
+            self.retry_at = max(self.retry_at, time.time() + retry_after)
+
+    def unreported(self, interval):
+        """Return the requests and failures counted since the last call,
+        or `None` if that was less than `interval` seconds ago.
+        """
+        with self._lock:
+            requests, failures, reported_at = self._reported
+            now = time.time()
+            if now - reported_at < interval:
+                return None
+            self._reported = (self.requests, self.failures, now)
+            return self.requests - requests, self.failures - failures
+
+    @property
+    def healthy(self):
+        return self.retry_at <= time.time()
+
+    def as_dict(self):
+        return {'url': self.url, 'requests': self.requests,
+                'failures': self.failures, 'latency': self.latency,
+                'error_rate': self.error_rate, 'healthy': self.healthy}
+
+
+_server_stats = {}
+_server_stats_lock = threading.Lock()
+
+
+def get_server_stats(url):
+    """Return the process wide :class:`ServerStats` of `url`."""
+    with _server_stats_lock:
+        if url not in _server_stats:
+            _server_stats[url] = ServerStats(url)
+        return _server_stats[url]
+
+
+def get_all_server_stats():
+    """Return the statistics of all servers used by this process."""
+    with _server_stats_lock:
+        stats = _server_stats.values()
+    return [s.as_dict() for s in sorted(stats, key=lambda s: s.url)]
+
+
+class _Method(object):
+    # Resolves dotted method names like `system.multicall`.
+
+    def __init__(self, send, name):
+        self._send = send
+        self._name = name
+
+    def __getattr__(self, name):
+        return _Method(self._send, '%s.%s' % (self._name, name))
+
+    def __call__(self, *args):
+        return self._send(self._name, args)
+
+
+class MirrorProxy(object):
+    """XML-RPC proxy sending every call to the best of several servers.
+
+    Servers are preferred in the given order as long as they are not
+    `tolerance` times slower than the fastest one measured.  Connection
+    and HTTP errors fail over to the next server and take the failed one
+    out of rotation for `retry_after` seconds.  A server whose guard
+    refuses the request is skipped until the guard allows requests again,
+    :exc:`~folivora.utils.circuit.Unavailable` is only raised if every
+    server refused.  XML-RPC faults are passed on as is.
+
+    :param servers: URLs in order of preference.
+    :param timeout: Socket timeout in seconds.
+    :param get_guard: Optional callable returning the request guard of the
+                      transport to a server URL.
+    :param report: Optional callable getting the :class:`ServerStats` of a
+                   server after every request to it.
+    """
+
+    def __init__(self, servers, timeout=DEFAULT_TIMEOUT, get_guard=None,
+                 tolerance=1.5, retry_after=30, report=None):
+        self.servers = []
+        for url in servers:
+            guard = get_guard(url) if get_guard is not None else None
+            transport = KeepAliveTransport(url.startswith('https:'), timeout,
+                                           guard=guard)
+            proxy = xmlrpclib.ServerProxy(url, transport=transport)
+            self.servers.append((get_server_stats(url), proxy))
+        self.tolerance = tolerance
+        self.retry_after = retry_after
+        self.report = report
+
+    def __getattr__(self, name):
+        return _Method(self._call, name)
+
+    def ordered_servers(self):
+        """Return ``(stats, proxy)`` pairs in the order they are tried."""
+        healthy = [(idx, server) for idx, server in enumerate(self.servers)
+                   if server[0].healthy]
+        latencies = [s.latency for idx, (s, p) in healthy
+                     if s.latency is not None]
+        limit = min(latencies) * self.tolerance if latencies else None
+
+        def key(item):
+            idx, (stats, proxy) = item
+            if stats.latency is None or stats.latency <= limit:
+                return (0, idx)
+            return (1, stats.latency)
+
+        unhealthy = [server for server in self.servers
+                     if not server[0].healthy]
+        unhealthy.sort(key=lambda server: server[0].retry_at)
+        return [server for idx, server in sorted(healthy, key=key)] + \
+            unhealthy
+
+    def _call(self, name, args):
+        error = None
+        for stats, proxy in self.ordered_servers():
+            start = time.time()
+            try:
+                result = getattr(proxy, name)(*args)
+            except xmlrpclib.Fault:
+                stats.success(time.time() - start)
+                self._report(stats)
+                raise
+            except (socket.error, httplib.HTTPException,
+                    xmlrpclib.ProtocolError) as exc:
+                stats.failure(self.retry_after)
+                self._report(stats)
+                error = exc
+                continue
+            except Unavailable as exc:
+                stats.refused(exc.retry_after)
+                error = exc
+                continue
+            stats.success(time.time() - start)
+            self._report(stats)
+            return result
+        raise error
+
+    def _report(self, stats):
+        if self.report is not None:
+            self.report(stats)
 
 
 class CheeseShop(object):
+    """Client for the XML-RPC interface of PyPi.
+
+    :param server: URL of the XML-RPC endpoint or a list of mirror URLs
+                   in order of preference, see :class:`MirrorProxy`.
+                   Defaults to :attr:`default_servers`.
+    :param batch_size: Number of calls sent in one multicall.
+    :param timeout: Socket timeout in seconds.
+    :param get_guard: Callable returning the request guard of a server
+                      URL, see :class:`MirrorProxy`.
+    :param report: Callable getting the statistics of a server after
+                   every request, see :class:`MirrorProxy`.
+    """
+
+    #: Servers used if none are given.
+    default_servers = [DEFAULT_SERVER]
+
+    def __init__(self, server=None, batch_size=DEFAULT_BATCH_SIZE,
+                 timeout=DEFAULT_TIMEOUT, get_guard=None, report=None):
+        if server is None:
+            server = self.default_servers
+        elif isinstance(server, basestring):
+            server = [server]
+        self.xmlrpc = MirrorProxy(server, timeout, get_guard, report=report)
+        self.batch_size = batch_size
+
+    def multicall(self, method, arguments):
+        """Call `method` once for every argument tuple in `arguments`.
 
-    def __init__(self, server=DEFAULT_SERVER):
-        self.xmlrpc = xmlrpclib.Server(server)
+        The calls are sent in batches of `batch_size` using
+        :class:`xmlrpclib.MultiCall`, results are returned in order.
+
+        :param method: Name of the XML-RPC method.
+        :param arguments: List of argument tuples.
+        """
+        results = []
+        for offset in xrange(0, len(arguments), self.batch_size):
+            multicall = xmlrpclib.MultiCall(self.xmlrpc)
+            for args in arguments[offset:offset + self.batch_size]:
+                getattr(multicall, method)(*args)
+            results.extend(multicall())
+        return results
 
     def get_package_versions(self, package_name):
         """Fetch list of available versions for a package.
@@ -34,6 +383,18 @@ class CheeseShop(object):
         """
         return self.xmlrpc.package_releases(package_name)
 
+    def get_multiple_package_versions(self, package_names):
+        """Fetch available versions for multiple packages at once.
+
+        Returns a dictionary mapping package names to their versions.
+
+        :param package_names: Names of the packages to query.
+        """
+        package_names = list(package_names)
+        results = self.multicall('package_releases',
+                                 [(name,) for name in package_names])
+        return dict(zip(package_names, results))
+
     def get_package_list(self):
         """Fetch the master list of package names."""
         return self.xmlrpc.list_packages()
@@ -51,6 +412,19 @@ class CheeseShop(object):
         seconds = get_seconds(hours) if not force_seconds else hours
         return self.xmlrpc.changelog(seconds)
 
+    def get_last_serial(self):
+        """Query the serial of the most recent changelog event."""
+        return self.xmlrpc.changelog_last_serial()
+
+    def get_changelog_since_serial(self, serial):
+        """Query all changelog events after `serial`.
+
+        Events are returned as ``(name, version, stamp, action, serial)``.
+
+        :param serial: Serial of the last event that was already processed.
+        """
+        return self.xmlrpc.changelog_since_serial(serial)
+
     def get_updated_releases(self, hours, force_seconds):
         """Query all updated releases within `hours`.
 
@@ -68,6 +442,19 @@ class CheeseShop(object):
         """
         return self.xmlrpc.release_urls(package_name, version)
 
+    def get_multiple_release_urls(self, package_name, versions):
+        """Query release urls for multiple versions of `package_name`.
+
+        Returns a dictionary mapping versions to their release urls.
+
+        :param package_name: Name of the package.
+        :param versions: Versions of the package.
+        """
+        versions = list(versions)
+        results = self.multicall('release_urls',
+                                 [(package_name, v) for v in versions])
+        return dict(zip(versions, results))
+
     def get_release_data(self, package_name, version=None):
         """Query for specific release data.
 
@@ -81,3 +468,65 @@ class CheeseShop(object):
                 return {}
             version = versions[-1]
         return self.xmlrpc.release_data(package_name, version)
+
+
+class ConcurrentCheeseShop(object):
+    """Runs :class:`CheeseShop` calls in a pool of threads.
+
+    The methods mirror :class:`CheeseShop` but return a
+    :class:`multiprocessing.pool.AsyncResult` immediately, call `get()` on
+    it for the response.  At most `concurrency` requests are in flight,
+    further calls are queued.
+
+    :param server: URL or URLs of the XML-RPC endpoint, see
+                   :class:`CheeseShop`.
+    :param concurrency: Number of threads and therefore connections.
+    :param kwargs: Passed on to the :class:`CheeseShop` of every thread.
+    """
+
+    def __init__(self, server=None, concurrency=DEFAULT_CONCURRENCY,
+                 **kwargs):
+        self.server = server
+        self.kwargs = kwargs
+        self.batch_size = kwargs.get('batch_size', DEFAULT_BATCH_SIZE)
+        self.pool = ThreadPool(concurrency)
+        self._local = threading.local()
+        # Keep the connections of all threads open between requests.
+        connection_pool.max_idle = max(connection_pool.max_idle, concurrency)
+
+    def _run(self, method, args):
+        # xmlrpclib.ServerProxy is not thread safe, every thread gets its
+        # own client.  Connections are shared through the pool anyway.
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = CheeseShop(self.server,
+                                                     **self.kwargs)
+        return getattr(client, method)(*args)
+
+    def _submit(self, method, *args):
+        return self.pool.apply_async(self._run, (method, args))
+
+    def get_package_versions(self, package_name):
+        return self._submit('get_package_versions', package_name)
+
+    def get_multiple_package_versions(self, package_names):
+        return self._submit('get_multiple_package_versions',
+                            list(package_names))
+
+    def get_release_urls(self, package_name, version):
+        return self._submit('get_release_urls', package_name, version)
+
+    def get_multiple_release_urls(self, package_name, versions):
+        return self._submit('get_multiple_release_urls', package_name,
+                            versions)
+
+    def get_changelog(self, hours, force_seconds=False):
+        return self._submit('get_changelog', hours, force_seconds)
+
+    def get_release_data(self, package_name, version=None):
+        return self._submit('get_release_data', package_name, version)
+
+    def close(self):
+        """Wait for all queued calls and stop the threads."""
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,110 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.recording
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Record PyPi responses to fixture files and serve them again, so that
+    syncronization can be benchmarked without depending on PyPi.
+"""
+import gzip
+import xmlrpclib
+
+from .pypi import CheeseShop, DEFAULT_BATCH_SIZE, _Method
+
+
+CHANGELOG_METHODS = ('changelog', 'changelog_since_serial')
+
+
+def save_responses(path, responses):
+    """Write recorded responses to the gzip compressed fixture `path`."""
+    with gzip.open(path, 'wb') as f:
+        f.write(xmlrpclib.dumps((responses,), allow_none=True))
+
+
+def load_responses(path):
+    """Load recorded responses from the fixture `path`."""
+    with gzip.open(path, 'rb') as f:
+        params, method = xmlrpclib.loads(f.read())
+    return params[0]
+
+
+class RecordingProxy(object):
+    """Wraps a :class:`xmlrpclib.ServerProxy` and records all responses.
+
+    Calls of a :class:`xmlrpclib.MultiCall` are recorded one by one.
+    """
+
+    def __init__(self, proxy, responses):
+        self._proxy = proxy
+        self._responses = responses
+
+    def __getattr__(self, name):
+        return _Method(self._call, name)
+
+    def _call(self, name, args):
+        result = getattr(self._proxy, name)(*args)
+        if name == 'system.multicall':
+            for call, value in zip(args[0], result):
+                # Faults are returned as dictionaries and not recorded.
+                if isinstance(value, list):
+                    self._responses.append([call['methodName'],
+                                            call['params'], value[0]])
+        else:
+            self._responses.append([name, list(args), result])
+        return result
+
+
+class ReplayProxy(object):
+    """Answers XML-RPC calls from recorded responses.
+
+    Calls that were not recorded raise a :class:`xmlrpclib.Fault`.
+    """
+
+    def __init__(self, responses):
+        self._responses = dict(((name, tuple(args)), result)
+                               for name, args, result in responses)
+
+    def __getattr__(self, name):
+        return _Method(self._call, name)
+
+    def _call(self, name, args):
+        if name == 'system.multicall':
+            return [[self._lookup(call['methodName'], call['params'])]
+                    for call in args[0]]
+        return self._lookup(name, args)
+
+    def _lookup(self, name, args):
+        try:
+            return self._responses[(name, tuple(args))]
+        except KeyError:
+            raise xmlrpclib.Fault(1, 'No recorded response for %s%r'
+                                     % (name, tuple(args)))
+
+
+class RecordingCheeseShop(CheeseShop):
+    """A :class:`CheeseShop` recording all responses, see :meth:`save`."""
+
+    def __init__(self, server=None, batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+        super(RecordingCheeseShop, self).__init__(server, batch_size,
+                                                  **kwargs)
+        self.responses = []
+        self.xmlrpc = RecordingProxy(self.xmlrpc, self.responses)
+
+    def save(self, path):
+        save_responses(path, self.responses)
+
+
+class ReplayCheeseShop(CheeseShop):
+    """A :class:`CheeseShop` serving the responses of a fixture file."""
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.responses = load_responses(path)
+        self.xmlrpc = ReplayProxy(self.responses)
+        self.batch_size = batch_size
+
+    def get_recorded_changelog(self):
+        """Return ``(method, args, events)`` of the recorded changelog."""
+        for name, args, result in self.responses:
+            if name in CHANGELOG_METHODS:
+                return name, args, result
+        raise ValueError('The fixture does not contain a changelog.')
@@ -0,0 +1,306 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.snapshot
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compact snapshots of the package catalog, to bootstrap a database
+    without talking to PyPi.
+
+    A snapshot is a gzip file starting with :data:`MAGIC`, followed by
+    length prefixed blocks: a JSON header and one block per column.
+    Strings are stored NUL terminated in UTF-8, package and version
+    columns refer to dictionaries of distinct values, release dates are
+    little endian int64 microseconds since the epoch.
+"""
+import sys
+import json
+import gzip
+import struct
+import datetime
+from array import array
+
+import pytz
+from django.db import connection, transaction
+from django.utils import timezone
+
+from ..models import Package, PackageVersion, SyncState
+from .bulk import copy_rows, normalized_name_sql
+from .versions import version_sort_key
+
+
+MAGIC = 'FOLIVORA-SNAPSHOT\n'
+FORMAT_VERSION = 1
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+#: Typecodes of :mod:`array` with the given item size.
+UINT8 = 'B'
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+_LENGTH = struct.Struct('<Q')
+_INT64_CHUNK = 65536
+
+
+def encode_strings(strings):
+    return ''.join(s.encode('utf-8') + '\0' for s in strings)
+
+
+def decode_strings(data):
+    return [s.decode('utf-8') for s in data.split('\0')[:-1]]
+
+
+def encode_array(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+
+def decode_array(typecode, data):
+    values = array(typecode)
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def encode_int64(values):
+    values = list(values)
+    return ''.join(
+        struct.pack('<%dq' % len(chunk), *chunk)
+        for chunk in (values[i:i + _INT64_CHUNK]
+                      for i in xrange(0, len(values), _INT64_CHUNK)))
+
+
+def decode_int64(data):
+    values = []
+    size = _INT64_CHUNK * 8
+    for offset in xrange(0, len(data), size):
+        chunk = data[offset:offset + size]
+        values.extend(struct.unpack('<%dq' % (len(chunk) // 8), chunk))
+    return values
+
+
+_ENCODERS = {
+    'str': (encode_strings, decode_strings),
+    'uint8': (lambda v: encode_array(UINT8, v),
+              lambda d: decode_array(UINT8, d)),
+    'uint32': (lambda v: encode_array(UINT32, v),
+               lambda d: decode_array(UINT32, d)),
+    'int64': (encode_int64, decode_int64),
+}
+
+
+def write_snapshot(fileobj, header, columns, compresslevel=6):
+    """Write a snapshot to `fileobj`.
+
+    :param header: Dictionary stored as JSON, the column layout is added.
+    :param columns: List of ``(name, type, values)`` with a type of
+                    ``str``, ``uint8``, ``uint32`` or ``int64``.
+    """
+    header = dict(header, format=FORMAT_VERSION,
+                  columns=[(name, type) for name, type, values in columns])
+    f = gzip.GzipFile(fileobj=fileobj, mode='wb',
+                      compresslevel=compresslevel)
+    try:
+        f.write(MAGIC)
+        blocks = [json.dumps(header)]
+        blocks.extend(_ENCODERS[type][0](values)
+                      for name, type, values in columns)
+        for block in blocks:
+            f.write(_LENGTH.pack(len(block)))
+            f.write(block)
+    finally:
+        f.close()
+
+
+def read_snapshot(fileobj):
+    """Read a snapshot, returns ``(header, {column name: values})``."""
+    f = gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+    def read_block():
+        length = f.read(_LENGTH.size)
+        if len(length) != _LENGTH.size:
+            raise ValueError('Truncated snapshot')
+        length, = _LENGTH.unpack(length)
+        block = f.read(length)
+        if len(block) != length:
+            raise ValueError('Truncated snapshot')
+        return block
+
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a snapshot')
+        header = json.loads(read_block())
+        if header.get('format') != FORMAT_VERSION:
+            raise ValueError('Unsupported snapshot format %r'
+                             % header.get('format'))
+        columns = dict((name, _ENCODERS[type][1](read_block()))
+                       for name, type in header['columns'])
+    finally:
+        f.close()
+    return header, columns
+
+
+def _to_microseconds(dt):
+    if timezone.is_naive(dt):
+        dt = dt.replace(tzinfo=pytz.UTC)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def export_catalog(fileobj, compresslevel=6):
+    """Write all packages and versions to `fileobj`.
+
+    Returns the number of exported packages and versions.
+    """
+    # The serial is read first, the changelog rather repeats events than
+    # missing some after an import.
+    serial = SyncState.objects.filter(type=SyncState.CHANGELOG) \
+                              .values_list('last_serial', flat=True)
+    serial = serial[0] if serial else None
+
+    names, urls, providers, synced = [], [], array(UINT8), array(UINT8)
+    synced_from = []
+    provider_codes = {}
+    package_index = {}
+    packages = Package.objects.order_by('id').values_list(
+        'id', 'name', 'url', 'provider', 'initial_sync_done', 'synced_from')
+    for (pk, name, url, provider, initial_sync_done,
+         since) in packages.iterator():
+        package_index[pk] = len(names)
+        names.append(name)
+        urls.append(url)
+        providers.append(provider_codes.setdefault(provider,
+                                                   len(provider_codes)))
+        synced.append(initial_sync_done)
+        # Versions are never empty, so the empty string stands for `None`.
+        synced_from.append(since or u'')
+
+    version_packages, version_codes = array(UINT32), array(UINT32)
+    release_dates = []
+    version_index = {}
+    versions = PackageVersion.objects.order_by('package', 'id').values_list(
+        'package', 'version', 'release_date')
+    for package_id, version, release_date in versions.iterator():
+        if package_id not in package_index:
+            # Created after the packages were read.
+            continue
+        version_packages.append(package_index[package_id])
+        version_codes.append(version_index.setdefault(version,
+                                                      len(version_index)))
+        release_dates.append(_to_microseconds(release_date))
+
+    def dictionary(index):
+        return sorted(index, key=index.get)
+
+    header = {
+        'serial': serial,
+        'created': timezone.now().isoformat(),
+        'packages': len(names),
+        'versions': len(version_codes),
+    }
+    write_snapshot(fileobj, header, [
+        ('package.name', 'str', names),
+        ('package.url', 'str', urls),
+        ('provider.dictionary', 'str', dictionary(provider_codes)),
+        ('package.provider', 'uint8', providers),
+        ('package.initial_sync_done', 'uint8', synced),
+        ('package.synced_from', 'str', synced_from),
+        ('version.dictionary', 'str', dictionary(version_index)),
+        ('version.package', 'uint32', version_packages),
+        ('version.version', 'uint32', version_codes),
+        ('version.release_date', 'int64', release_dates),
+    ], compresslevel)
+    return len(names), len(version_codes)
+
+
+def import_catalog(fileobj, chunk_size=10000):
+    """Load a snapshot written by :func:`export_catalog`.
+
+    Packages and versions that already exist are kept, the changelog sync
+    starts at the serial of the snapshot unless it ran before.  Returns
+    the number of new packages and versions.
+    """
+    header, columns = read_snapshot(fileobj)
+    names = columns['package.name']
+    provider_dictionary = columns['provider.dictionary']
+    versions = columns['version.dictionary']
+
+    with transaction.commit_on_success():
+        cursor = connection.cursor()
+        cursor.execute('CREATE TEMPORARY TABLE folivora_snapshot_package '
+                       '(idx integer, name text, url text, provider text, '
+                       'initial_sync_done boolean, synced_from text) '
+                       'ON COMMIT DROP')
+        cursor.execute('CREATE TEMPORARY TABLE folivora_snapshot_dictionary '
+                       '(code integer, version text, sort_key text) '
+                       'ON COMMIT DROP')
+        cursor.execute('CREATE TEMPORARY TABLE folivora_snapshot_version '
+                       '(package integer, version integer, '
+                       'release_date bigint) ON COMMIT DROP')
+        copy_rows(cursor, 'folivora_snapshot_package',
+                  ('idx', 'name', 'url', 'provider', 'initial_sync_done',
+                   'synced_from'),
+                  ((idx, name, url, provider_dictionary[provider],
+                    bool(synced), since or None)
+                   for idx, (name, url, provider, synced, since) in enumerate(
+                       zip(names, columns['package.url'],
+                           columns['package.provider'],
+                           columns['package.initial_sync_done'],
+                           columns['package.synced_from']))),
+                  chunk_size)
+        # Sort keys are computed once per distinct version string.
+        copy_rows(cursor, 'folivora_snapshot_dictionary',
+                  ('code', 'version', 'sort_key'),
+                  ((code, version, version_sort_key(version))
+                   for code, version in enumerate(versions)),
+                  chunk_size)
+        copy_rows(cursor, 'folivora_snapshot_version',
+                  ('package', 'version', 'release_date'),
+                  zip(columns['version.package'], columns['version.version'],
+                      columns['version.release_date']),
+                  chunk_size)
+        # Temporary tables are not analyzed automatically.
+        cursor.execute('ANALYZE folivora_snapshot_package')
+        cursor.execute('ANALYZE folivora_snapshot_dictionary')
+        cursor.execute('ANALYZE folivora_snapshot_version')
+
+        cursor.execute(
+            'INSERT INTO folivora_package (name, normalized_name, url, '
+            'provider, initial_sync_done, synced_from) '
+            'SELECT name, %s, url, provider, initial_sync_done, synced_from '
+            'FROM folivora_snapshot_package ORDER BY idx '
+            'ON CONFLICT DO NOTHING' % normalized_name_sql('name'))
+        created_packages = cursor.rowcount
+        cursor.execute(
+            'UPDATE folivora_package p SET initial_sync_done = true, '
+            'synced_from = s.synced_from FROM folivora_snapshot_package s '
+            'WHERE s.name = p.name AND s.initial_sync_done '
+            'AND NOT p.initial_sync_done')
+        cursor.execute(
+            "INSERT INTO folivora_packageversion (package_id, version, "
+            "release_date, sort_key) "
+            "SELECT p.id, d.version, timestamp with time zone 'epoch' + "
+            "v.release_date * interval '1 microsecond', d.sort_key "
+            "FROM folivora_snapshot_version v "
+            "JOIN folivora_snapshot_package s ON s.idx = v.package "
+            "JOIN folivora_package p ON p.name = s.name "
+            "JOIN folivora_snapshot_dictionary d ON d.code = v.version "
+            "ON CONFLICT (package_id, version) DO NOTHING")
+        created_versions = cursor.rowcount
+        cursor.execute(
+            'UPDATE folivora_package SET latest_version_id = latest.id '
+            'FROM (SELECT DISTINCT ON (package_id) package_id, id '
+            '      FROM folivora_packageversion WHERE package_id IN ('
+            '        SELECT p.id FROM folivora_package p '
+            '        JOIN folivora_snapshot_package s ON s.name = p.name) '
+            '      ORDER BY package_id, sort_key DESC) AS latest '
+            'WHERE folivora_package.id = latest.package_id')
+
+        if header.get('serial') is not None and not SyncState.objects.filter(
+                type=SyncState.CHANGELOG).exists():
+            SyncState.objects.create(type=SyncState.CHANGELOG,
+                                     last_sync=timezone.now(),
+                                     last_serial=header['serial'])
+    return created_packages, created_versions
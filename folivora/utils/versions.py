@@ -0,0 +1,42 @@
+#-*- coding: utf-8 -*-
+"""
+    folivora.utils.versions
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Utilities to compare version strings in the database.
+"""
+from distutils.version import LooseVersion
+
+
+def version_sort_key(version):
+    """Return a string that sorts like ``LooseVersion(version)``.
+
+    Numeric components are prefixed by ``1`` and their length, all other
+    components by ``2`` and terminated by a space.  Comparing the keys
+    byte by byte (``COLLATE "C"``) therefore gives the same result as
+    comparing the :class:`LooseVersion` objects, where numbers sort
+    before strings and shorter versions before longer ones.
+    """
+    parts = []
+    for component in LooseVersion(version).version:
+        if isinstance(component, (int, long)):
+            digits = str(component)
+            parts.append('1%03d%s' % (len(digits), digits))
+        else:
+            parts.append('2%s ' % component)
+    return ''.join(parts)
+
+
+def versions_since(versions, since):
+    """Return the `versions` that sort at or after `since`.
+
+    The most recent version is always included.  If `since` is `None` all
+    `versions` are returned.
+    """
+    versions = list(versions)
+    if since is None or not versions:
+        return versions
+    keys = dict((v, version_sort_key(v)) for v in versions)
+    lowest = version_sort_key(since)
+    latest = max(versions, key=keys.get)
+    return [v for v in versions if keys[v] >= lowest or v == latest]